@@ -12,15 +12,26 @@ discovery and echo wave algorithms.
 from random import randint, gauss
 from gui import MainWindow
 from tkinter import TclError
-from dataclasses import dataclass
+from dataclasses import dataclass, asdict, field
+from array import array
+from bisect import insort
 
+import os
 import sys
+import cProfile
+import collections
+import json
+import mmap
 import struct
 import socket
 import sensor
 import math
+import heapq
+import queue
 import select
+import threading
 import time
+import traceback
 
 
 @dataclass
@@ -34,6 +45,8 @@ class Neighbour:
         strength (int): Signal strength of the neighbour.
         distance (float): Calculated distance to the neighbour.
         last_seen (float): Timestamp when neighbour was last heard from.
+        provisional (bool): Whether the neighbour was restored from a
+            snapshot and has not answered a ping since.
     """
 
     ip: str
@@ -41,6 +54,158 @@ class Neighbour:
     strength: int
     distance: float
     last_seen: float
+    provisional: bool = False
+
+
+class NeighbourTable:
+    """
+    Neighbour table stored as columns instead of one object per neighbour.
+
+    Every neighbour gets a slot in a set of array columns, and freed slots
+    are reused. Two indexes are kept up to date on every change: a min-heap
+    on last_seen, so expiring stale neighbours only touches the expired
+    ones, and a list sorted by distance for ordered views. Rows are handed
+    out as Neighbour objects that are copies of the columns.
+    """
+
+    def __init__(self):
+        self._slots: dict[tuple[int, int], int] = {}
+        self._free: list[int] = []
+        self._ip: list[str] = []
+        self._port = array("i")
+        self._strength = array("i")
+        self._distance = array("d")
+        self._last_seen = array("d")
+        self._provisional = bytearray()
+
+        # (last_seen, position) entries, outdated ones are skipped lazily.
+        self._expiry: list[tuple[float, tuple[int, int]]] = []
+        # (distance, position) entries in ascending order.
+        self._by_distance: list[tuple[float, tuple[int, int]]] = []
+
+    def __len__(self):
+        return len(self._slots)
+
+    def __contains__(self, position):
+        return position in self._slots
+
+    def __iter__(self):
+        return iter(self._slots)
+
+    def __getitem__(self, position):
+        return self._row(self._slots[position])
+
+    def keys(self):
+        return self._slots.keys()
+
+    def values(self):
+        return (self._row(slot) for slot in self._slots.values())
+
+    def items(self):
+        return (
+            (position, self._row(slot))
+            for position, slot in self._slots.items()
+        )
+
+    def update(
+        self,
+        position,
+        ip,
+        port,
+        strength,
+        distance,
+        last_seen,
+        provisional=False,
+    ):
+        """Add a neighbour, or overwrite the entry at its position."""
+
+        slot = self._slots.get(position)
+        if slot is None:
+            if self._free:
+                slot = self._free.pop()
+            else:
+                slot = len(self._ip)
+                self._ip.append("")
+                self._port.append(0)
+                self._strength.append(0)
+                self._distance.append(0)
+                self._last_seen.append(0)
+                self._provisional.append(0)
+            self._slots[position] = slot
+            insort(self._by_distance, (distance, position))
+        elif self._distance[slot] != distance:
+            self._by_distance.remove((self._distance[slot], position))
+            insort(self._by_distance, (distance, position))
+
+        self._ip[slot] = ip
+        self._port[slot] = port
+        self._strength[slot] = strength
+        self._distance[slot] = distance
+        self._last_seen[slot] = last_seen
+        self._provisional[slot] = provisional
+        heapq.heappush(self._expiry, (last_seen, position))
+
+    def set_distance(self, position, distance):
+        slot = self._slots[position]
+        self._by_distance.remove((self._distance[slot], position))
+        insort(self._by_distance, (distance, position))
+        self._distance[slot] = distance
+
+    def discard(self, position):
+        """Remove the neighbour at position if there is one."""
+
+        slot = self._slots.pop(position, None)
+        if slot is None:
+            return
+        self._by_distance.remove((self._distance[slot], position))
+        self._ip[slot] = ""
+        self._free.append(slot)
+
+    def expire(self, cutoff):
+        """
+        Remove the neighbours that were last seen before cutoff.
+
+        Returns:
+            list[tuple[int, int]]: Positions of the removed neighbours.
+        """
+
+        expired = []
+        while self._expiry and self._expiry[0][0] < cutoff:
+            last_seen, position = heapq.heappop(self._expiry)
+            slot = self._slots.get(position)
+            # Skip entries of neighbours that were removed or seen again.
+            if slot is not None and self._last_seen[slot] == last_seen:
+                self.discard(position)
+                expired.append(position)
+
+        # Every refresh pushes an entry, drop the outdated ones now and then.
+        if len(self._expiry) > 4 * len(self._slots) + 64:
+            self._expiry = [
+                (self._last_seen[slot], position)
+                for position, slot in self._slots.items()
+            ]
+            heapq.heapify(self._expiry)
+
+        return expired
+
+    def by_distance(self, reverse=False):
+        """Return (position, Neighbour) pairs ordered by distance."""
+
+        entries = reversed(self._by_distance) if reverse else self._by_distance
+        return [
+            (position, self._row(self._slots[position]))
+            for _, position in entries
+        ]
+
+    def _row(self, slot):
+        return Neighbour(
+            ip=self._ip[slot],
+            port=self._port[slot],
+            strength=self._strength[slot],
+            distance=self._distance[slot],
+            last_seen=self._last_seen[slot],
+            provisional=bool(self._provisional[slot]),
+        )
 
 
 @dataclass
@@ -54,13 +219,339 @@ class Wave:
         operation (int): The operation type for this wave.
         parent (tuple[int, int] | None): Position of the parent node that sent
             this wave.
-        payload_sum (int): Accumulated payload for size calculation operations.
+        parent_address (tuple[str, int] | None): Address of the parent, kept
+            so the reply still arrives if the parent left our neighbour table.
+        payload_sum (float): Accumulated payload of the subtree (node count,
+            sum of means, minimum or maximum depending on the operation).
+        payload_count (int): Number of nodes that contributed a mean.
+        window (float): Length in seconds of the reading window aggregated
+            by this wave.
+        acks (list[tuple[int, int]]): Positions of the nodes in the subtree
+            that applied a configuration wave.
+        started_at (float): Time the wave reached this node.
     """
 
     children_waiting: set[tuple[int, int]]
     operation: int = sensor.OP_NOOP
     parent: tuple[int, int] | None = None
-    payload_sum: int = 0
+    parent_address: tuple[str, int] | None = None
+    payload_sum: float = 0
+    payload_count: int = 0
+    window: float = 0
+    acks: list[tuple[int, int]] = field(default_factory=list)
+    started_at: float = field(default_factory=time.time)
+
+
+@dataclass
+class WindowStats:
+    """
+    Aggregates over the readings of a time window.
+
+    Attributes:
+        count (int): Number of readings in the window.
+        mean (float): Mean of the readings.
+        minimum (float): Smallest reading.
+        maximum (float): Largest reading.
+    """
+
+    count: int
+    mean: float
+    minimum: float
+    maximum: float
+
+
+class ReadingHistory:
+    """
+    Fixed-capacity ring buffer of timestamped sensor readings.
+
+    Timestamps and values live in preallocated arrays, so memory use does not
+    grow with uptime. The values are also kept in a sum/min/max segment tree
+    that is updated on every append, which makes window aggregates an
+    O(log n) query instead of a scan over the window.
+
+    Attributes:
+        capacity (int): Maximum number of readings kept.
+    """
+
+    def __init__(self, capacity):
+        if capacity < 1:
+            raise ValueError("capacity must be at least 1")
+        self.capacity = capacity
+        self._times = array("d", [0.0]) * capacity
+        self._sum = array("d", [0.0]) * (2 * capacity)
+        self._min = array("d", [math.inf]) * (2 * capacity)
+        self._max = array("d", [-math.inf]) * (2 * capacity)
+        self._head = 0
+        self._count = 0
+
+    def __len__(self):
+        return self._count
+
+    def append(self, timestamp, value):
+        """
+        Store a reading, overwriting the oldest one when the buffer is full.
+
+        Args:
+            timestamp (float): Time of the reading, must not be older than
+                the previous one.
+            value (float): The measured value.
+        """
+
+        slot = self._head
+        self._times[slot] = timestamp
+        self._head = (slot + 1) % self.capacity
+        self._count = min(self._count + 1, self.capacity)
+
+        # Update the leaf and every ancestor up to the root.
+        i = slot + self.capacity
+        self._sum[i] = self._min[i] = self._max[i] = value
+        i >>= 1
+        while i:
+            left, right = 2 * i, 2 * i + 1
+            self._sum[i] = self._sum[left] + self._sum[right]
+            self._min[i] = min(self._min[left], self._min[right])
+            self._max[i] = max(self._max[left], self._max[right])
+            i >>= 1
+
+    def window(self, seconds, now=None):
+        """
+        Aggregate the readings of the last `seconds` seconds.
+
+        Args:
+            seconds (float): Length of the window.
+            now (float | None): End of the window, defaults to the current
+                time.
+
+        Returns:
+            WindowStats | None: The aggregates, or None if the window holds
+                no readings.
+        """
+
+        if now is None:
+            now = time.time()
+        cutoff = now - seconds
+
+        # Binary search for the oldest reading inside the window.
+        oldest = self._head - self._count
+        lo, hi = 0, self._count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._times[(oldest + mid) % self.capacity] < cutoff:
+                lo = mid + 1
+            else:
+                hi = mid
+
+        count = self._count - lo
+        if count == 0:
+            return None
+
+        start = (oldest + lo) % self.capacity
+        if start + count <= self.capacity:
+            total, low, high = self._query(start, start + count)
+        else:
+            total, low, high = self._query(start, self.capacity)
+            wrapped = self._query(0, start + count - self.capacity)
+            total += wrapped[0]
+            low = min(low, wrapped[1])
+            high = max(high, wrapped[2])
+
+        return WindowStats(count, total / count, low, high)
+
+    def _query(self, lo, hi):
+        """Return the (sum, min, max) of the slots in [lo, hi)."""
+
+        total, low, high = 0.0, math.inf, -math.inf
+        lo += self.capacity
+        hi += self.capacity
+        while lo < hi:
+            if lo & 1:
+                total += self._sum[lo]
+                low = min(low, self._min[lo])
+                high = max(high, self._max[lo])
+                lo += 1
+            if hi & 1:
+                hi -= 1
+                total += self._sum[hi]
+                low = min(low, self._min[hi])
+                high = max(high, self._max[hi])
+            lo >>= 1
+            hi >>= 1
+        return total, low, high
+
+
+class NodeSnapshot:
+    """
+    Memory-mapped snapshot of the state a node needs for a warm restart.
+
+    The file has a fixed size: a header with the wave sequence counter and the
+    node's own port, followed by a fixed number of neighbour records. Because
+    the file is mapped into memory, updating the counter is a plain memory
+    write that the OS persists even if the process is killed.
+
+    Attributes:
+        path (str): Location of the snapshot file.
+        capacity (int): Maximum number of neighbour records.
+    """
+
+    MAGIC = b"DSN1"
+
+    # magic, own port, neighbour count, waves sent.
+    _header = struct.Struct("!4sHHI")
+    # x, y, ip, port, strength.
+    _record = struct.Struct("!ii4sHi")
+
+    def __init__(self, path, capacity=256):
+        self.path = path
+        self.capacity = capacity
+        size = self._header.size + capacity * self._record.size
+
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            if os.fstat(fd).st_size != size:
+                os.ftruncate(fd, 0)
+                os.ftruncate(fd, size)
+            self._map = mmap.mmap(fd, size)
+        finally:
+            os.close(fd)
+
+        if self._map[:4] != self.MAGIC:
+            self._header.pack_into(self._map, 0, self.MAGIC, 0, 0, 0)
+
+    def load(self):
+        """
+        Read the stored state.
+
+        Returns:
+            tuple[int, int, list]: The waves sent counter, the node's previous
+                port (0 if unknown) and a list of (position, ip, port,
+                strength) tuples of the stored neighbours.
+        """
+
+        _, port, count, waves_sent = self._header.unpack_from(self._map, 0)
+        neighbours = []
+        for i in range(min(count, self.capacity)):
+            offset = self._header.size + i * self._record.size
+            x, y, ip, n_port, strength = self._record.unpack_from(
+                self._map, offset
+            )
+            neighbours.append(((x, y), socket.inet_ntoa(ip), n_port, strength))
+        return waves_sent, port, neighbours
+
+    def store_port(self, port):
+        struct.pack_into("!H", self._map, 4, port)
+
+    def store_sequence(self, waves_sent):
+        struct.pack_into("!I", self._map, 8, waves_sent)
+
+    def store_neighbours(self, neighbours):
+        """
+        Overwrite the stored neighbour table, keeping the closest neighbours
+        if there are more than fit in the file.
+
+        Args:
+            neighbours (NeighbourTable): The neighbours.
+        """
+
+        closest = neighbours.by_distance()[: self.capacity]
+        for i, (position, neighbour) in enumerate(closest):
+            offset = self._header.size + i * self._record.size
+            self._record.pack_into(
+                self._map,
+                offset,
+                position[0],
+                position[1],
+                socket.inet_aton(neighbour.ip),
+                neighbour.port,
+                neighbour.strength,
+            )
+        struct.pack_into("!H", self._map, 6, len(closest))
+
+    def close(self):
+        self._map.flush()
+        self._map.close()
+
+
+class MulticastShards:
+    """
+    Maps grid cells to a range of multicast groups.
+
+    The grid is divided into square cells and every cell gets its own group,
+    counting up from the base group address. A node pings on the group of its
+    own cell and listens on the groups of the cells its strength radius
+    intersects. A link needs the distance to be within both nodes' strength,
+    so no link is lost by not hearing pings from further away.
+
+    Attributes:
+        base_group (str): Group address of cell (0, 0).
+        port (int): Multicast port shared by all groups.
+        cell_size (int): Length of the side of a cell.
+        cells_per_side (int): Number of cells along each axis of the grid.
+    """
+
+    def __init__(self, base_group, port, cell_size, grid_size):
+        self.base_group = base_group
+        self.port = port
+        self.cell_size = cell_size
+        self.cells_per_side = grid_size // cell_size + 1
+
+        self._base = struct.unpack("!I", socket.inet_aton(base_group))[0]
+        last_group = self._base + self.cells_per_side**2 - 1
+        if last_group > 0xEFFFFFFF:  # 239.255.255.255
+            raise ValueError(
+                "not enough multicast groups after %s for %d cells"
+                % (base_group, self.cells_per_side**2)
+            )
+
+    def group_for(self, position):
+        """Return the multicast address of the cell containing position."""
+
+        cx, cy = self._cell_of(position)
+        return self._group(cx, cy), self.port
+
+    def groups_within(self, position, radius):
+        """
+        Return the groups of all cells that intersect the circle of the given
+        radius around position.
+
+        Returns:
+            set[str]: The multicast group addresses.
+        """
+
+        x, y = position
+        low_x, low_y = self._cell_of((x - radius, y - radius))
+        high_x, high_y = self._cell_of((x + radius, y + radius))
+
+        groups = set()
+        for cx in range(low_x, high_x + 1):
+            left, right = self._bounds(cx)
+            dx = max(left - x, 0, x - right)
+            for cy in range(low_y, high_y + 1):
+                # Distance from the position to the closest point of the cell.
+                bottom, top = self._bounds(cy)
+                dy = max(bottom - y, 0, y - top)
+                if math.hypot(dx, dy) <= radius:
+                    groups.add(self._group(cx, cy))
+        return groups
+
+    def _bounds(self, c):
+        """Return the extent of cell row or column c along its axis. The
+        edge cells also hold the positions off the grid, see _cell_of."""
+
+        low = c * self.cell_size if c > 0 else -math.inf
+        high = (c + 1) * self.cell_size
+        if c == self.cells_per_side - 1:
+            high = math.inf
+        return low, high
+
+    def _cell_of(self, position):
+        last = self.cells_per_side - 1
+        cx = min(max(int(position[0] // self.cell_size), 0), last)
+        cy = min(max(int(position[1] // self.cell_size), 0), last)
+        return cx, cy
+
+    def _group(self, cx, cy):
+        index = cy * self.cells_per_side + cx
+        return socket.inet_ntoa(struct.pack("!I", self._base + index))
 
 
 # Get random position in NxN grid.
@@ -78,6 +569,124 @@ def calculate_distance(point_a, point_b):
     return distance
 
 
+class CommandError(Exception):
+    """Raised when a command is unknown or has invalid arguments."""
+
+
+def _parse_number(text, kind):
+    try:
+        return kind(text)
+    except ValueError:
+        raise CommandError(f"not a number: {text}") from None
+
+
+def _float32(value, name):
+    """
+    Round value to the float32 that carries it in a message payload.
+
+    Raises:
+        CommandError: If value is not finite or does not fit in a float32.
+    """
+
+    if not math.isfinite(value):
+        raise CommandError(f"{name} must be a finite number")
+    try:
+        return struct.unpack("!f", struct.pack("!f", value))[0]
+    except OverflowError:
+        raise CommandError(f"{name} is too large") from None
+
+
+# Profiler phase names of the message handlers.
+HANDLER_PHASES = {
+    sensor.MSG_PING: "handle ping",
+    sensor.MSG_PONG: "handle pong",
+    sensor.MSG_ECHO: "handle echo",
+    sensor.MSG_ECHO_REPLY: "handle echo reply",
+    sensor.MSG_ANNOUNCE: "handle announce",
+}
+
+
+class LoopProfiler:
+    """
+    Sampling profiler for the phases of the event loops.
+
+    Only one in every `every` loop passes is timed, so the cost of profiling
+    stays low. Each thread counts its own passes. For every phase the number
+    of timed calls, the total time and the longest call are kept.
+
+    Attributes:
+        every (int): Time one in this many passes, 0 disables profiling.
+    """
+
+    def __init__(self, every=0):
+        self.every = every
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._stats: dict[str, list] = {}
+
+    @property
+    def active(self):
+        """Whether the current pass of the calling thread is timed."""
+
+        return getattr(self._local, "active", False)
+
+    def next_pass(self):
+        """Start a loop pass of the calling thread.
+
+        Returns:
+            bool: Whether this pass is timed.
+        """
+
+        if not self.every:
+            return False
+        passes = getattr(self._local, "passes", 0) + 1
+        self._local.passes = passes
+        self._local.active = passes % self.every == 0
+        return self._local.active
+
+    def call(self, phase, func, *args):
+        """Call func with args, timing it as phase if the pass is timed."""
+
+        if not self.active:
+            return func(*args)
+
+        start = time.perf_counter()
+        try:
+            return func(*args)
+        finally:
+            self.record(phase, time.perf_counter() - start)
+
+    def record(self, phase, seconds):
+        with self._lock:
+            stats = self._stats.setdefault(phase, [0, 0.0, 0.0])
+            stats[0] += 1
+            stats[1] += seconds
+            stats[2] = max(stats[2], seconds)
+
+    def reset(self):
+        with self._lock:
+            self._stats.clear()
+
+    def summary(self):
+        """
+        Returns:
+            list[dict]: Statistics per phase, most total time first.
+        """
+
+        with self._lock:
+            rows = [
+                {
+                    "phase": phase,
+                    "count": count,
+                    "total_ms": total * 1e3,
+                    "mean_us": total / count * 1e6,
+                    "max_us": longest * 1e6,
+                }
+                for phase, (count, total, longest) in self._stats.items()
+            ]
+        return sorted(rows, key=lambda row: row["total_ms"], reverse=True)
+
+
 class SensorNode:
     """
     Main sensor node that participates in a distributed sensor network.
@@ -93,18 +702,89 @@ class SensorNode:
         value (float): Sensor measurement value.
         ping_period (float): Time interval between periodic pings.
         grid_size (int): Size of the network grid.
-        neighbours (dict[tuple[int, int], Neighbour]): Discovered neighbouring
-            sensors.
+        sample_period (float): Time interval between readings of the sensor
+            value.
+        readings (ReadingHistory): Recent timestamped readings.
+        snapshot (NodeSnapshot | None): Snapshot used for warm restarts.
+        shards (MulticastShards | None): Cell to multicast group mapping, or
+            None if every node uses the single group mcast_addr.
+        control (ControlServer | None): Local control socket for scripts.
+        profiler (LoopProfiler): Phase timings of the event loops.
+        cprofile_path (str | None): File that receives cProfile statistics
+            of the network thread on exit.
+        recorder (TrafficRecorder | None): Capture of all datagrams.
+        neighbours (NeighbourTable): Discovered neighbouring sensors.
         ip (str): Local IP address.
         port (int): Local port number.
         window (MainWindow): GUI interface instance.
+        log (callable): Queues a line for the GUI, safe to call from the
+            network thread.
+
+    The GUI runs on the main thread and the sockets, timers and wave
+    controller on a separate network thread, so redrawing the window never
+    delays packet handling. The threads only share two SimpleQueues: typed
+    commands go to the network thread and log lines come back.
     """
 
+    # Commands that start a wave and get their result when it decides.
+    WAVE_COMMANDS = ("echo", "size", "mean", "min", "max", "config")
+
+    # Settings that can be pushed to the whole network with config.
+    SETTINGS = {"strength": sensor.CFG_STRENGTH, "period": sensor.CFG_PERIOD}
+
+    # Largest strength, every whole number up to it is exact in the float32
+    # payload of a configuration wave.
+    MAX_STRENGTH = 2**24
+
+    # Shortest ping period that can be set. The neighbour TTL is three
+    # periods, so much shorter periods expire neighbours between loop passes.
+    MIN_PERIOD = 1.0
+
     def __init__(
-        self, mcast_addr, position, strength, value, ping_period, grid_size
+        self,
+        mcast_addr,
+        position,
+        strength,
+        value,
+        ping_period,
+        grid_size,
+        sample_period=1,
+        history_size=3600,
+        snapshot_path=None,
+        cell_size=0,
+        control_port=None,
+        send_rate=0,
+        total_send_rate=0,
+        profile_every=0,
+        cprofile_path=None,
+        capture_path=None,
     ):
-        self.listener = MulticastListener(mcast_addr)
-        self.peer_messenger = PeerMessenger()
+        self._commands = queue.SimpleQueue()
+        self._log_lines = queue.SimpleQueue()
+        self.log = self._log_lines.put
+        self._stop = threading.Event()
+        self.profiler = LoopProfiler(profile_every)
+        self.cprofile_path = cprofile_path
+        self.recorder = TrafficRecorder(capture_path) if capture_path else None
+
+        self.shards = None
+        if cell_size > 0:
+            self.shards = MulticastShards(
+                mcast_addr[0], mcast_addr[1], cell_size, grid_size
+            )
+
+        self.listener = MulticastListener(
+            mcast_addr,
+            sharded=self.shards is not None,
+            log=self.log,
+            recorder=self.recorder,
+        )
+        self.peer_messenger = PeerMessenger(
+            log=self.log,
+            rate=send_rate,
+            total_rate=total_send_rate,
+            recorder=self.recorder,
+        )
 
         self.mcast_addr = mcast_addr
         self.position = position
@@ -112,46 +792,200 @@ class SensorNode:
         self.value = value
         self.ping_period = ping_period
         self.grid_size = grid_size
-
-        self.neighbours: dict[tuple[int, int], Neighbour] = {}
+        self.sample_period = sample_period
+        self.readings = ReadingHistory(history_size)
+        self.snapshot = NodeSnapshot(snapshot_path) if snapshot_path else None
+        self.control = None
+        if control_port is not None:
+            self.control = ControlServer(control_port, self.execute)
+
+        self.neighbours = NeighbourTable()
         self.next_ping_at = time.time()
+        self.next_sample_at = time.time()
         self.window = None
 
     def start(self):
         """
         Initialize the sensor node and start the main event loop.
 
-        Sets up network sockets, GUI interface, and begins listening for
-        network messages and user commands.
+        Sets up network sockets and the GUI interface, starts the network
+        thread and runs the GUI loop until the window is closed.
         """
 
-        self.peer_messenger.start()
+        waves_sent, port, stored = 0, 0, []
+        if self.snapshot is not None:
+            waves_sent, port, stored = self.snapshot.load()
+
+        # Try to get the previous port back so peers' tables stay valid.
+        self.peer_messenger.start(port)
         self.listener.start()
+        if self.control is not None:
+            self.control.start()
 
         ip, port = self.peer_messenger.get_address()
         self.ip = ip
         self.port = port
+        if self.recorder is not None:
+            self.recorder.record_start(self.position, self.strength)
 
         # make the gui.
         self.window = MainWindow()
-        self.window.writeln(
-            "my address is %s:%s" % self.peer_messenger.get_address()
-        )
-        self.window.writeln("my position is (%s, %s)" % self.position)
+        self.log("my address is %s:%s" % self.peer_messenger.get_address())
+        self.log("my position is (%s, %s)" % self.position)
+        if self.control is not None:
+            self.log("control socket at %s:%s" % self.control.get_address())
 
         self.wave_controller = EchoWaveController(
-            self, self.peer_messenger, self.window.writeln
+            self, self.peer_messenger, self.log
         )
+        self.wave_controller.waves_sent = waves_sent
+        self._update_subscriptions()
+        self._restore_neighbours(stored)
+        if self.snapshot is not None:
+            self.snapshot.store_port(self.port)
 
-        # This is the event loop.
+        network_thread = threading.Thread(target=self._network_loop)
+        network_thread.start()
+
+        # This is the GUI loop.
         try:
-            while self.window.update():
-                self._handle_incoming_messages()
-                self._periodic_ping()
-                self._handle_gui_commands()
+            while True:
+                self.profiler.next_pass()
+                if not self.profiler.call("gui update", self.window.update):
+                    break
+                self._show_log_lines()
+                if self._stop.is_set():
+                    # The network thread died, see _network_loop.
+                    break
+                line = self.window.getline()
+                if line:
+                    self._commands.put(line)
+                time.sleep(0.02)
 
         except TclError:
             pass
+        finally:
+            self._stop.set()
+            network_thread.join()
+            if self.snapshot is not None:
+                self.snapshot.store_neighbours(self.neighbours)
+                self.snapshot.close()
+            if self.recorder is not None:
+                self.recorder.close()
+
+    def _network_loop(self):
+        """Handle sockets, timers and commands until the GUI stops."""
+
+        # cProfile only sees the thread it is enabled in.
+        profile = None
+        if self.cprofile_path:
+            profile = cProfile.Profile()
+            profile.enable()
+
+        try:
+            while not self._stop.is_set():
+                timed = self.profiler.next_pass()
+                start = time.perf_counter()
+
+                self._handle_incoming_messages()
+                self.profiler.call("ping", self._periodic_ping)
+                self.profiler.call("sample", self._periodic_sample)
+                self.profiler.call("commands", self._handle_gui_commands)
+                self.profiler.call(
+                    "waves", self.wave_controller.expire, time.time()
+                )
+                self.profiler.call("flush", self.peer_messenger.flush)
+
+                if timed:
+                    elapsed = time.perf_counter() - start
+                    self.profiler.record("network pass", elapsed)
+        except Exception as e:
+            # Errors of single messages and commands are caught below, so
+            # this is a bug. Stop the node instead of leaving a window that
+            # looks alive but handles no traffic.
+            self.log(f"Error: network thread stopped ({e!r})")
+            traceback.print_exc()
+        finally:
+            self._stop.set()
+            if profile is not None:
+                profile.disable()
+                profile.dump_stats(self.cprofile_path)
+
+    def _show_log_lines(self):
+        """Write the lines queued by the network thread to the window."""
+
+        while True:
+            try:
+                line = self._log_lines.get_nowait()
+            except queue.Empty:
+                return
+            self.window.writeln(line)
+
+    def _ping(self):
+        """Multicast a ping, on the group of our own cell when sharded."""
+
+        address = self.mcast_addr
+        if self.shards is not None:
+            address = self.shards.group_for(self.position)
+        self.peer_messenger.send_ping(
+            address, self.position, self.position, self.strength
+        )
+
+    def _update_subscriptions(self):
+        """
+        In sharded mode, listen on exactly the groups of the cells within our
+        strength radius. Called on start and whenever the position or strength
+        changes.
+        """
+
+        if self.shards is None:
+            return
+
+        wanted = self.shards.groups_within(self.position, self.strength)
+        for group in self.listener.groups - wanted:
+            self.listener.leave(group)
+        for group in wanted - self.listener.groups:
+            try:
+                self.listener.join(group)
+            except OSError as e:
+                # The OS limits memberships per socket (20 on Linux).
+                self.log(
+                    f"Error: could not join {group} ({e}), "
+                    "use a larger cell size."
+                )
+                return
+
+    def _restore_neighbours(self, stored):
+        """
+        Add the neighbours from a snapshot as provisional entries. They take
+        part in waves right away and are replaced by the pongs to the first
+        ping, or expire like any other neighbour if no pong arrives.
+
+        Args:
+            stored (list): (position, ip, port, strength) tuples.
+        """
+
+        now = time.time()
+        for position, ip, port, strength in stored:
+            if position == self.position:
+                continue
+
+            # The node may have been restarted at another position.
+            distance = calculate_distance(self.position, position)
+            if distance <= min(self.strength, strength):
+                self.neighbours.update(
+                    position,
+                    ip=ip,
+                    port=port,
+                    strength=strength,
+                    distance=distance,
+                    last_seen=now,
+                    provisional=True,
+                )
+
+        if stored:
+            restored = len(self.neighbours)
+            self.log(f"restored {restored} neighbours from snapshot")
 
     def _handle_incoming_messages(self):
         """Process incoming network messages from multicast and peer sockets.
@@ -161,43 +995,97 @@ class SensorNode:
         """
 
         sockets = [self.listener.socket, self.peer_messenger.socket]
+        writable = []
+        if self.control is not None:
+            sockets += self.control.read_sockets
+            writable = self.control.write_sockets
+
+        # Wake up sooner while paced messages are waiting for tokens.
+        timeout = 0.005 if self.peer_messenger.pending else 0.05
 
         # Read any incoming messages
-        rlist, _, _ = select.select(sockets, [], [], 0.05)
+        rlist, wlist, _ = self.profiler.call(
+            "select", select.select, sockets, writable, [], timeout
+        )
 
-        if self.listener.socket in rlist:
-            message, address = self.listener.poll()
-            message_type = message[0]
+        if self.control is not None:
+            self.profiler.call("control", self.control.handle, rlist, wlist)
 
-            if message_type == sensor.MSG_PING:
-                self._handle_ping(message, address)
+        if self.listener.socket in rlist:
+            message, address = self.profiler.call(
+                "receive", self.listener.poll
+            )
+            if message is not None:
+                self._dispatch(self._dispatch_multicast, message, address)
 
         if self.peer_messenger.socket in rlist:
-            message, address = self.peer_messenger.poll()
-            message_type = message[0]
+            message, address = self.profiler.call(
+                "receive", self.peer_messenger.poll
+            )
+            if message is not None:
+                self._dispatch(self._dispatch_peer, message, address)
+
+    def _dispatch(self, handler, message, address):
+        """Run handler on a message, logging errors instead of letting one
+        message stop the network thread."""
+
+        try:
+            self.profiler.call(
+                HANDLER_PHASES.get(message[0], "handle other"),
+                handler,
+                message,
+                address,
+            )
+        except Exception as e:
+            self.log(
+                f"Error: could not handle message from "
+                f"{address[0]}:{address[1]} ({e!r})"
+            )
 
-            if message_type == sensor.MSG_PONG:
-                self._handle_pong(message, address)
-            elif message_type == sensor.MSG_ECHO:
-                self.wave_controller.handle_echo(message, address)
-            elif message_type == sensor.MSG_ECHO_REPLY:
-                self.wave_controller.handle_echo_reply(message)
+    def _dispatch_multicast(self, message, address):
+        """Hand a message from the multicast socket to its handler."""
+
+        message_type = message[0]
+
+        if message_type == sensor.MSG_PING:
+            self._handle_ping(message, address)
+        elif message_type == sensor.MSG_ANNOUNCE:
+            self._handle_announce(message, address)
+
+    def _dispatch_peer(self, message, address):
+        """Hand a message from the peer socket to its handler."""
+
+        message_type = message[0]
+
+        if message_type == sensor.MSG_PONG:
+            self._handle_pong(message, address)
+        elif message_type == sensor.MSG_ECHO:
+            self.wave_controller.handle_echo(message, address)
+        elif message_type == sensor.MSG_ECHO_REPLY:
+            self.wave_controller.handle_echo_reply(message)
 
     def _periodic_ping(self):
         """Send periodic ping messages and clean up stale neighbours."""
 
         now = time.time()
         if self.ping_period > 0 and now >= self.next_ping_at:
-            self.peer_messenger.send_ping(
-                self.mcast_addr, self.position, self.position, self.strength
-            )
+            self._ping()
             self.next_ping_at = now + self.ping_period
 
+            if self.snapshot is not None:
+                self.snapshot.store_neighbours(self.neighbours)
+
         # remove old/stale neighbours
         ttl = 3 * self.ping_period
-        for pos in list(self.neighbours.keys()):
-            if now - self.neighbours[pos].last_seen > ttl:
-                del self.neighbours[pos]
+        self.neighbours.expire(now - ttl)
+
+    def _periodic_sample(self):
+        """Record the sensor value in the reading history when it is due."""
+
+        now = time.time()
+        if self.sample_period > 0 and now >= self.next_sample_at:
+            self.readings.append(now, self.value)
+            self.next_sample_at = now + self.sample_period
 
     def _handle_pong(self, decoded_message, address):
         neighbour_position = decoded_message[3]
@@ -208,7 +1096,8 @@ class SensorNode:
 
         distance = calculate_distance(self.position, neighbour_position)
         if distance <= neighbour_strength:
-            self.neighbours[neighbour_position] = Neighbour(
+            self.neighbours.update(
+                neighbour_position,
                 ip=address[0],
                 port=address[1],
                 strength=neighbour_strength,
@@ -229,8 +1118,98 @@ class SensorNode:
                 address, initiator_position, self.position, self.strength
             )
 
+    def _handle_announce(self, decoded_message, address):
+        """
+        Update the entry of a neighbour that moved or changed its strength,
+        and answer it like a ping so it learns about us if we are now in
+        range.
+        """
+
+        new_position = decoded_message[2]
+        old_position = decoded_message[3]
+        if new_position == self.position:
+            return
+
+        strength = decoded_message[6]
+        if old_position != new_position:
+            self.neighbours.discard(old_position)
+
+        distance = calculate_distance(self.position, new_position)
+        if distance <= min(self.strength, strength):
+            self.neighbours.update(
+                new_position,
+                ip=address[0],
+                port=address[1],
+                strength=strength,
+                distance=distance,
+                last_seen=time.time(),
+            )
+        else:
+            self.neighbours.discard(new_position)
+
+        self._handle_ping(decoded_message, address)
+
+    def _revalidate(self, old_position):
+        """
+        Bring the neighbour table up to date after our position or strength
+        changed: recompute distances, drop the neighbours that are out of
+        range now and announce the change so that peers update their tables
+        and new peers in range answer with a pong.
+
+        Args:
+            old_position (tuple[int, int]): Position before the change.
+        """
+
+        if self.recorder is not None:
+            self.recorder.record_node(self.position, self.strength)
+
+        for position, neighbour in list(self.neighbours.items()):
+            distance = calculate_distance(self.position, position)
+            if distance > min(self.strength, neighbour.strength):
+                self.neighbours.discard(position)
+            else:
+                self.neighbours.set_distance(position, distance)
+
+        self._update_subscriptions()
+
+        # Peers that knew us are listening on our old cell, new peers on our
+        # new cell.
+        addresses = {self.mcast_addr}
+        if self.shards is not None:
+            addresses = {
+                self.shards.group_for(old_position),
+                self.shards.group_for(self.position),
+            }
+        for address in addresses:
+            self.peer_messenger.send_announce(
+                address, self.position, old_position, self.strength
+            )
+
     def _handle_gui_commands(self):
-        """Process user commands from the GUI interface. Parses the input.
+        """Run the commands typed into the GUI interface and log the
+        results."""
+
+        while True:
+            try:
+                line = self._commands.get_nowait()
+            except queue.Empty:
+                return
+            parts = line.strip().split(" ")
+
+            try:
+                result = self.execute(parts)
+            except CommandError as e:
+                self.log(str(e))
+                continue
+            except Exception as e:
+                self.log(f"Error: {parts[0]} failed ({e!r})")
+                continue
+
+            for text in self._format_result(parts[0].lower(), result):
+                self.log(text)
+
+    def execute(self, parts, on_wave=None):
+        """Run a command for the GUI or the control socket.
 
         Handles commands like:
             properties,
@@ -239,52 +1218,197 @@ class SensorNode:
             move,
             strength,
             echo,
-            size
+            size,
+            window,
+            mean,
+            min,
+            max,
+            config,
+            profile
+
+        Args:
+            parts (list[str]): The command followed by its arguments.
+            on_wave (callable | None): Called with the result of the wave
+                when a wave started by this command decides.
+
+        Returns:
+            The result of the command as plain data, or None if it has no
+            result. Wave commands return the wave's sequence number.
+
+        Raises:
+            CommandError: If the command is unknown or its arguments are
+                invalid.
         """
 
-        line = self.window.getline()
-        if not line:
-            return
-        parts = line.strip().split(" ")
         cmd = parts[0].lower()
 
         if cmd == "properties":
-            self.window.writeln(
-                f"{self.position};{self.value};{self.strength};{self.ip}:{self.port}"
-            )
+            return {
+                "position": self.position,
+                "value": self.value,
+                "strength": self.strength,
+                "address": f"{self.ip}:{self.port}",
+            }
         elif cmd == "ping":
-            self.peer_messenger.send_ping(
-                self.mcast_addr, self.position, self.position, self.strength
-            )
+            self._ping()
         elif cmd == "list":
-            sorted_neighbours = sorted(
-                self.neighbours.items(),
-                key=lambda x: x[1].distance,
-                reverse=True,
-            )
-            for location, neighbour in sorted_neighbours:
-                self.window.writeln(f"{location};{neighbour.distance}")
+            sorted_neighbours = self.neighbours.by_distance(reverse=True)
+            return [
+                {
+                    "position": location,
+                    "distance": neighbour.distance,
+                    "provisional": neighbour.provisional,
+                }
+                for location, neighbour in sorted_neighbours
+            ]
         elif cmd == "move":
-            x = int(parts[1])
-            y = int(parts[2])
             if len(parts) != 3:
-                self.window.writeln("usage: move <x> <y>")
-            elif x > self.grid_size or y > self.grid_size:
-                self.window.writeln("x and y must be within grid")
-            else:
-                self.position = (x, y)
-                self._periodic_ping()  # Re-ping to adjust neighbours
+                raise CommandError("usage: move <x> <y>")
+            x = _parse_number(parts[1], int)
+            y = _parse_number(parts[2], int)
+            if not (0 <= x <= self.grid_size and 0 <= y <= self.grid_size):
+                raise CommandError("x and y must be within grid")
+            old_position = self.position
+            self.position = (x, y)
+            self._revalidate(old_position)
         elif cmd == "strength":
             if len(parts) != 2:
-                self.window.writeln("usage: strength <new_value>")
-            elif int(parts[1]) < 0:
-                self.window.writeln("strength must be greater than 0")
-            else:
-                self.strength = int(parts[1])
+                raise CommandError("usage: strength <new_value>")
+            strength = _parse_number(parts[1], int)
+            if strength < 1:
+                raise CommandError("strength must be greater than 0")
+            self.apply_setting(sensor.CFG_STRENGTH, strength)
         elif cmd == "echo":
-            self.wave_controller.start_echo_wave()
+            return self.wave_controller.start_echo_wave(on_decide=on_wave)
         elif cmd == "size":
-            self.wave_controller.start_echo_wave(sensor.OP_SIZE)
+            return self.wave_controller.start_echo_wave(
+                sensor.OP_SIZE, on_decide=on_wave
+            )
+        elif cmd in ("window", "mean", "min", "max"):
+            if len(parts) > 2:
+                raise CommandError(f"usage: {cmd} [seconds]")
+            seconds = 60
+            if len(parts) == 2:
+                seconds = _float32(_parse_number(parts[1], float), "seconds")
+            if cmd == "window":
+                stats = self.readings.window(seconds)
+                return None if stats is None else asdict(stats)
+
+            operation = {
+                "mean": sensor.OP_MEAN,
+                "min": sensor.OP_MIN,
+                "max": sensor.OP_MAX,
+            }[cmd]
+            return self.wave_controller.start_echo_wave(
+                operation, seconds, on_decide=on_wave
+            )
+        elif cmd == "config":
+            if len(parts) != 3 or parts[1] not in self.SETTINGS:
+                raise CommandError("usage: config <strength|period> <value>")
+            setting = self.SETTINGS[parts[1]]
+            # Apply the value the other nodes get from the payload.
+            value = _float32(_parse_number(parts[2], float), parts[1])
+            self.check_setting(setting, value)
+            return self.wave_controller.start_echo_wave(
+                sensor.OP_CONFIG,
+                on_decide=on_wave,
+                setting=setting,
+                value=value,
+            )
+        elif cmd == "profile":
+            if not self.profiler.every:
+                raise CommandError("profiling is off, start with --profile N")
+            if len(parts) == 2 and parts[1] == "reset":
+                self.profiler.reset()
+                return None
+            if len(parts) != 1:
+                raise CommandError("usage: profile [reset]")
+            return self.profiler.summary()
+        else:
+            raise CommandError(f"unknown command: {cmd}")
+
+    def check_setting(self, setting, value):
+        """
+        Raises:
+            CommandError: If value is not valid for the setting.
+        """
+
+        if not math.isfinite(value):
+            raise CommandError("value must be a finite number")
+        if setting == sensor.CFG_STRENGTH:
+            # A strength of 0 drops every link, including the ones a later
+            # configuration wave would need to undo it.
+            if not 1 <= value <= self.MAX_STRENGTH or value != int(value):
+                raise CommandError(
+                    f"strength must be a whole number from 1 to "
+                    f"{self.MAX_STRENGTH}"
+                )
+        elif setting == sensor.CFG_PERIOD:
+            # A period of 0 turns pinging off, and with it the expiry would
+            # drop every neighbour, so it cannot be pushed to other nodes.
+            if value < self.MIN_PERIOD:
+                raise CommandError(
+                    f"period must be at least {self.MIN_PERIOD:g} seconds"
+                )
+        else:
+            raise CommandError(f"unknown setting: {setting}")
+
+    def apply_setting(self, setting, value):
+        """
+        Change a setting. All state that depends on it is updated in the
+        same call, so the node never runs with half of a change.
+
+        Args:
+            setting (int): One of the sensor.CFG_* settings.
+            value (float): The new value.
+
+        Raises:
+            CommandError: If value is not valid for the setting.
+        """
+
+        self.check_setting(setting, value)
+        if setting == sensor.CFG_STRENGTH:
+            self.strength = int(value)
+            self._revalidate(self.position)
+        elif setting == sensor.CFG_PERIOD:
+            self.ping_period = value
+            self.next_ping_at = min(self.next_ping_at, time.time() + value)
+
+    def _format_result(self, cmd, result):
+        """Return the lines the GUI prints for the result of a command."""
+
+        if cmd == "properties":
+            return [
+                f"{self.position};{self.value};{self.strength};{self.ip}:{self.port}"
+            ]
+        elif cmd == "list":
+            lines = []
+            for entry in result:
+                line = f"{entry['position']};{entry['distance']}"
+                if entry["provisional"]:
+                    line += ";provisional"
+                lines.append(line)
+            return lines
+        elif cmd == "window":
+            if result is None:
+                return ["no readings in window"]
+            return [
+                f"n={result['count']};mean={result['mean']};"
+                f"min={result['minimum']};max={result['maximum']}"
+            ]
+        elif cmd == "profile" and result is not None:
+            lines = [
+                f"{'phase':<18}{'count':>8}{'total ms':>11}"
+                f"{'mean us':>10}{'max us':>10}"
+            ]
+            for row in result:
+                lines.append(
+                    f"{row['phase']:<18}{row['count']:>8}"
+                    f"{row['total_ms']:>11.1f}{row['mean_us']:>10.1f}"
+                    f"{row['max_us']:>10.1f}"
+                )
+            return lines
+        return []
 
 
 class MulticastListener:
@@ -295,11 +1419,20 @@ class MulticastListener:
 
     Attributes:
         mcast_addr (tuple[str, int]): Multicast address to listen on.
+        sharded (bool): Whether groups are joined per grid cell with
+            join() and leave() instead of joining mcast_addr on start.
+        log (callable): Logging function for errors.
+        recorder (TrafficRecorder | None): Log of received datagrams.
+        groups (set[str]): Multicast groups the socket is subscribed to.
         _sock (socket.socket | None): The multicast socket instance.
     """
 
-    def __init__(self, mcast_addr):
+    def __init__(self, mcast_addr, sharded=False, log=print, recorder=None):
         self.mcast_addr = mcast_addr
+        self.sharded = sharded
+        self.log = log
+        self.recorder = recorder
+        self.groups: set[str] = set()
         self._sock = None
 
     def start(self):
@@ -307,7 +1440,8 @@ class MulticastListener:
         Initialize and bind the multicast socket.
 
         Creates the multicast socket and binds to the specified multicast
-        address.
+        address. In sharded mode the socket is bound to the port only, and
+        groups are joined later.
         """
 
         # Create the multicast listener socket.
@@ -319,42 +1453,206 @@ class MulticastListener:
         # of the program on the same machine at the same time.
         self._sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
 
+        if self.sharded:
+            if sys.platform.startswith("linux"):
+                # Only deliver groups joined by this socket, not every group
+                # joined by any socket on the host.
+                self._sock.setsockopt(
+                    socket.IPPROTO_IP,
+                    getattr(socket, "IP_MULTICAST_ALL", 49),
+                    0,
+                )
+            if sys.platform == "win32":  # windows special case
+                self._sock.bind(("localhost", self.mcast_addr[1]))
+            else:
+                self._sock.bind(("", self.mcast_addr[1]))
+            return
+
         # Subscribe the socket to multicast messages from the given address.
-        mreq = struct.pack(
-            "4sl", socket.inet_aton(self.mcast_addr[0]), socket.INADDR_ANY
-        )
-        self._sock.setsockopt(
-            socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, mreq
-        )
+        self.join(self.mcast_addr[0])
         if sys.platform == "win32":  # windows special case
             self._sock.bind(("localhost", self.mcast_addr[1]))
         else:  # should work for everything else
             self._sock.bind(self.mcast_addr)
 
-    def poll(self):
-        """
-        Receive and decode messages from the multicast socket.
+    def join(self, group):
+        """Subscribe the socket to a multicast group."""
+
+        mreq = struct.pack("4sl", socket.inet_aton(group), socket.INADDR_ANY)
+        self._sock.setsockopt(
+            socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, mreq
+        )
+        self.groups.add(group)
+
+    def leave(self, group):
+        """Unsubscribe the socket from a multicast group."""
+
+        mreq = struct.pack("4sl", socket.inet_aton(group), socket.INADDR_ANY)
+        self._sock.setsockopt(
+            socket.IPPROTO_IP, socket.IP_DROP_MEMBERSHIP, mreq
+        )
+        self.groups.discard(group)
+
+    def poll(self):
+        """
+        Receive and decode messages from the multicast socket.
+
+        Returns:
+            tuple[decoded_message, address]: The decoded message and sender
+                address. The message is None if receiving or decoding
+                fails.
+        """
+
+        try:
+            data, address = self._sock.recvfrom(65535)
+        except OSError as e:
+            # E.g. an ICMP error for an earlier send, reported on this call.
+            self.log(f"Error: receive failed ({e})")
+            return None, None
+        if self.recorder is not None:
+            self.recorder.record(
+                TrafficRecorder.IN, TrafficRecorder.MULTICAST, address, data
+            )
+
+        try:
+            decoded_message = sensor.message_decode(data)
+        except Exception:
+            self.log("Error: Received message was not in the proper format.")
+            return None, address
+
+        return decoded_message, address
+
+    @property
+    def socket(self):
+        return self._sock
+
+
+class TrafficRecorder:
+    """
+    Append-only binary log of the datagrams a node sends and receives.
+
+    Every record is a fixed header (timestamp, direction, channel, IPv4
+    address, port and length) followed by the datagram. START and NODE
+    records hold the node's position and strength instead of a datagram. A
+    START record begins every run of a node, so runs that were appended to
+    the same file can be told apart. NODE records are written after every
+    move or strength change, so a replay can follow the node.
+    """
+
+    # Directions.
+    IN = 0
+    OUT = 1
+    NODE = 2
+    START = 3
+
+    # Channels.
+    MULTICAST = 0
+    PEER = 1
+
+    _header = struct.Struct("!dBB4sHH")
+    _node = struct.Struct("!iii")
+
+    def __init__(self, path):
+        self._file = open(path, "ab")
+
+    def record(self, direction, channel, address, data):
+        self._file.write(
+            self._header.pack(
+                time.time(),
+                direction,
+                channel,
+                socket.inet_aton(address[0]),
+                address[1],
+                len(data),
+            )
+        )
+        self._file.write(data)
+
+    def record_node(self, position, strength, direction=NODE):
+        data = self._node.pack(position[0], position[1], strength)
+        self.record(direction, self.PEER, ("0.0.0.0", 0), data)
+
+    def record_start(self, position, strength):
+        self.record_node(position, strength, self.START)
+
+    def close(self):
+        self._file.close()
+
+    @classmethod
+    def read(cls, path):
+        """
+        Read a capture file. A record cut off at the end of the file, as
+        left by a crash, is ignored.
+
+        Yields:
+            tuple: (timestamp, direction, channel, address, data) per record.
+                For START and NODE records data is a (position, strength)
+                tuple.
+        """
+
+        with open(path, "rb") as f:
+            while True:
+                header = f.read(cls._header.size)
+                if len(header) < cls._header.size:
+                    return
+                timestamp, direction, channel, ip, port, length = (
+                    cls._header.unpack(header)
+                )
+                data = f.read(length)
+                if len(data) < length:
+                    return
+
+                if direction in (cls.NODE, cls.START):
+                    x, y, strength = cls._node.unpack(data)
+                    data = ((x, y), strength)
+                address = (socket.inet_ntoa(ip), port)
+                yield timestamp, direction, channel, address, data
+
+
+class OfflineSocket:
+    """
+    Stands in for the peer socket while replaying a capture. Outgoing
+    datagrams are counted and dropped.
+
+    Attributes:
+        sent (int): Number of datagrams sent.
+        sent_bytes (int): Total size of the datagrams sent.
+    """
 
-        Returns:
-            tuple[decoded_message, address]: The decoded message and sender
-                address, or None if decoding fails.
-        """
+    def __init__(self, address=("127.0.0.1", 0)):
+        self._address = address
+        self.sent = 0
+        self.sent_bytes = 0
 
-        data, address = self._sock.recvfrom(4096)
+    def sendto(self, data, address):
+        self.sent += 1
+        self.sent_bytes += len(data)
 
-        try:
-            decoded_message = sensor.message_decode(data)
-        except Exception:
-            self.window.writeln(
-                "Error: Received message was not in the proper format."
-            )
-            return
+    def getsockname(self):
+        return self._address
 
-        return decoded_message, address
 
-    @property
-    def socket(self):
-        return self._sock
+class TokenBucket:
+    """
+    Token bucket rate limiter.
+
+    Attributes:
+        rate (float): Tokens added per second.
+        burst (float): Maximum number of tokens.
+        tokens (float): Tokens currently available.
+        updated_at (float): Time of the last refill.
+    """
+
+    def __init__(self, rate, burst, now):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated_at = now
+
+    def refill(self, now):
+        elapsed = now - self.updated_at
+        self.tokens = min(self.burst, self.tokens + elapsed * self.rate)
+        self.updated_at = now
 
 
 class PeerMessenger:
@@ -363,16 +1661,54 @@ class PeerMessenger:
     This class manages the UDP socket for direct communication with other
     sensors, namely ping/pong messagse and echo wave messages.
 
+    When rate limits are set, outgoing messages are queued and sent by
+    flush() as tokens allow, so a wave fan-out does not hit receivers as
+    one burst. There is a token bucket per destination and one for all
+    traffic. Echo replies are sent before echoes, and both before
+    ping, pong and announce messages.
+
     Attributes:
+        log (callable): Logging function for errors.
+        recorder (TrafficRecorder | None): Log of sent and received
+            datagrams.
+        rate (float): Messages per second per destination (0=unlimited).
+        total_rate (float): Messages per second in total (0=unlimited).
         _sock (socket.socket | None): The UDP socket.
+        _lanes (tuple[deque, ...]): Queued (message, address) pairs per
+            priority, highest priority first.
+        _buckets (dict[tuple[str, int], TokenBucket]): Per destination
+            buckets.
+        _prune_at (float): Time from which idle buckets may be dropped
+            again.
+        _total (TokenBucket | None): Bucket for all traffic.
     """
 
-    def __init__(self):
+    PRIORITY_REPLY = 0
+    PRIORITY_WAVE = 1
+    PRIORITY_DISCOVERY = 2
+
+    def __init__(self, log=print, rate=0, total_rate=0, recorder=None):
+        self.log = log
+        self.recorder = recorder
+        self.rate = rate
+        self.total_rate = total_rate
         self._sock = None
+        self._lanes = tuple(collections.deque() for _ in range(3))
+        self._buckets = {}
+        self._prune_at = 0.0
+        self._total = None
+        if total_rate:
+            self._total = TokenBucket(
+                total_rate, self._burst(total_rate), time.time()
+            )
 
-    def start(self):
+    def start(self, port=0):
         """
-        Initialize and bind the peer-to-peer UDP socket using a random port.
+        Initialize and bind the peer-to-peer UDP socket.
+
+        Args:
+            port (int): Port to bind to. A random port is used if this is 0
+                or if the port is no longer available.
         """
 
         # Create the peer-to-peer socket.
@@ -380,16 +1716,27 @@ class PeerMessenger:
             socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP
         )
 
-        self._sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-
         # Set the socket multicast TTL so it can send multicast messages.
         self._sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, 5)
 
-        # Bind the socket to a random port.
         if sys.platform == "win32":  # windows special case
-            self._sock.bind(("localhost", socket.INADDR_ANY))
+            host = "localhost"
         else:  # should work for everything else
-            self._sock.bind(("", socket.INADDR_ANY))
+            host = ""
+
+        # The requested port is bound before SO_REUSEADDR is set, so that
+        # binding fails instead of sharing the port with a running node.
+        if port:
+            try:
+                self._sock.bind((host, port))
+                return
+            except OSError:
+                pass
+
+        self._sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+
+        # Bind the socket to a random port.
+        self._sock.bind((host, socket.INADDR_ANY))
 
     def poll(self):
         """
@@ -397,18 +1744,26 @@ class PeerMessenger:
 
         Returns:
             tuple[decoded_message, address]: The decoded message and sender
-                address, or None if decoding fails.
+                address. The message is None if receiving or decoding
+                fails.
         """
 
-        data, address = self._sock.recvfrom(4096)
+        try:
+            data, address = self._sock.recvfrom(65535)
+        except OSError as e:
+            # E.g. an ICMP error for an earlier send, reported on this call.
+            self.log(f"Error: receive failed ({e})")
+            return None, None
+        if self.recorder is not None:
+            self.recorder.record(
+                TrafficRecorder.IN, TrafficRecorder.PEER, address, data
+            )
 
         try:
             decoded_message = sensor.message_decode(data)
         except Exception:
-            self.window.writeln(
-                "Error: Received message was not in the proper format."
-            )
-            return
+            self.log("Error: Received message was not in the proper format.")
+            return None, address
 
         return decoded_message, address
 
@@ -416,6 +1771,94 @@ class PeerMessenger:
         ip, port = self._sock.getsockname()
         return ip, port
 
+    @property
+    def pending(self):
+        """Number of messages waiting to be sent."""
+
+        return sum(len(lane) for lane in self._lanes)
+
+    def flush(self):
+        """
+        Send queued messages in priority order for as long as the buckets
+        have tokens. Messages to a destination without tokens stay queued in
+        order, without holding up messages to other destinations.
+        """
+
+        if not self.pending:
+            return
+
+        now = time.time()
+        if self._total is not None:
+            self._total.refill(now)
+
+        for lane in self._lanes:
+            # Messages to destinations without tokens, in queue order. They
+            # go back to the front of the lane, so that the lane keeps the
+            # order of the messages to every destination.
+            blocked = []
+            while lane:
+                if self._total is not None and self._total.tokens < 1:
+                    break
+
+                msg, address = lane.popleft()
+                if self.rate:
+                    bucket = self._bucket(address, now)
+                    if bucket.tokens < 1:
+                        blocked.append((msg, address))
+                        continue
+                    bucket.tokens -= 1
+                if self._total is not None:
+                    self._total.tokens -= 1
+                self._transmit(msg, address)
+            lane.extendleft(reversed(blocked))
+
+        # Forget destinations that have been idle long enough to be full.
+        if len(self._buckets) > 1024 and now >= self._prune_at:
+            for address, bucket in list(self._buckets.items()):
+                bucket.refill(now)
+                if bucket.tokens >= bucket.burst:
+                    del self._buckets[address]
+            self._prune_at = now + 1
+
+    def start_offline(self):
+        """Use an OfflineSocket instead of a real one, for replays."""
+
+        self._sock = OfflineSocket()
+
+    def _send(self, msg, address, priority):
+        if not self.rate and not self.total_rate:
+            self._transmit(msg, address)
+        else:
+            self._lanes[priority].append((msg, address))
+
+    def _transmit(self, msg, address):
+        # A lost datagram is no worse than a dropped one, so a failing send
+        # is logged rather than stopping the network thread.
+        try:
+            self._sock.sendto(msg, address)
+        except OSError as e:
+            ip, port = address
+            self.log(f"Error: could not send to {ip}:{port} ({e})")
+            return
+        if self.recorder is not None:
+            self.recorder.record(
+                TrafficRecorder.OUT, TrafficRecorder.PEER, address, msg
+            )
+
+    def _bucket(self, address, now):
+        bucket = self._buckets.get(address)
+        if bucket is None:
+            bucket = TokenBucket(self.rate, self._burst(self.rate), now)
+            self._buckets[address] = bucket
+        else:
+            bucket.refill(now)
+        return bucket
+
+    @staticmethod
+    def _burst(rate):
+        # Allow a tenth of a second worth of messages at once.
+        return max(1.0, rate / 10)
+
     def send_pong(
         self, address, initiator_position, sender_position, strength
     ):
@@ -430,7 +1873,7 @@ class PeerMessenger:
             0,
         )
 
-        self._sock.sendto(msg, address)
+        self._send(msg, address, self.PRIORITY_DISCOVERY)
 
     def send_ping(
         self, address, initiator_position, sender_position, strength
@@ -446,7 +1889,21 @@ class PeerMessenger:
             0,
         )
 
-        self._sock.sendto(msg, address)
+        self._send(msg, address, self.PRIORITY_DISCOVERY)
+
+    def send_announce(self, address, position, old_position, strength):
+        msg = sensor.message_encode(
+            sensor.MSG_ANNOUNCE,
+            0,
+            position,
+            old_position,
+            (0, 0),
+            0,
+            strength,
+            0,
+        )
+
+        self._send(msg, address, self.PRIORITY_DISCOVERY)
 
     def send_echo(
         self,
@@ -457,19 +1914,23 @@ class PeerMessenger:
         strength,
         operation=sensor.OP_NOOP,
         payload=0,
+        setting=0,
+        incarnation=0,
     ):
+        # The target field carries the setting of a configuration wave and
+        # the incarnation of the initiator.
         msg = sensor.message_encode(
             sensor.MSG_ECHO,
             sequence_number,
             initiator_position,
             sender_position,
-            (0, 0),
+            (setting, incarnation),
             operation,
             strength,
             payload,
         )
 
-        self._sock.sendto(msg, address)
+        self._send(msg, address, self.PRIORITY_WAVE)
 
     def send_echo_reply(
         self,
@@ -480,25 +1941,77 @@ class PeerMessenger:
         strength,
         operation=sensor.OP_NOOP,
         payload=0,
+        count=0,
+        acks=(),
+        incarnation=0,
     ):
+        # The target field is unused by replies, so it carries the number of
+        # nodes that contributed to a mean or applied a configuration, and
+        # the incarnation of the initiator. The positions of those nodes
+        # follow the message, as far as they fit.
         msg = sensor.message_encode(
             sensor.MSG_ECHO_REPLY,
             sequence_number,
             initiator_position,
             sender_position,
-            (0, 0),
+            (count, incarnation),
             operation,
             strength,
             payload,
+            sensor.positions_encode(acks[: sensor.max_positions]),
         )
 
-        self._sock.sendto(msg, address)
+        self._send(msg, address, self.PRIORITY_REPLY)
 
     @property
     def socket(self):
         return self._sock
 
 
+class CompletedWaves:
+    """
+    Bounded record of recently completed waves.
+
+    Wave IDs, (initiator position, incarnation, sequence number) tuples,
+    are packed into a single integer and kept in a set for O(1) lookups,
+    plus a ring in insertion order so the oldest ID is forgotten once the
+    capacity is reached.
+
+    Attributes:
+        capacity (int): Number of wave IDs remembered.
+    """
+
+    def __init__(self, capacity=4096):
+        self.capacity = capacity
+        self._ring = collections.deque()
+        self._ids = set()
+
+    def __contains__(self, key):
+        return self._pack(key) in self._ids
+
+    def __len__(self):
+        return len(self._ids)
+
+    def add(self, key):
+        packed = self._pack(key)
+        if packed in self._ids:
+            return
+        if len(self._ring) >= self.capacity:
+            self._ids.discard(self._ring.popleft())
+        self._ring.append(packed)
+        self._ids.add(packed)
+
+    @staticmethod
+    def _pack(key):
+        (x, y), incarnation, sequence_number = key
+        return (
+            (x & 0xFFFF) << 80
+            | (y & 0xFFFF) << 64
+            | (incarnation & 0xFFFFFFFF) << 32
+            | sequence_number & 0xFFFFFFFF
+        )
+
+
 class EchoWaveController:
     """
     Controls echo wave propagation algorithms in the network.
@@ -510,41 +2023,82 @@ class EchoWaveController:
         msg (PeerMessenger): Reference to the messaging system.
         log (callable): Logging function for the GUI.
         waves_sent (int): Counter of initiated waves.
-        ongoing_waves (dict): State containing active waves.
+        incarnation (int): Random number that tells our waves apart from
+            those of an earlier run of this node, which reused the same
+            position and sequence numbers.
+        ongoing_waves (dict): State containing active waves, by
+            (initiator position, incarnation, sequence number).
+        completed (CompletedWaves): Recently completed waves, so late or
+            duplicated messages do not restart them.
+        _on_decide (dict[int, callable]): Callbacks for the results of our
+            own waves, by sequence number.
+
+    A wave that still waits for replies after `timeout` seconds, e.g.
+    because a reply was lost, is given up. If it is our own wave its
+    callback gets a result with an "error" entry.
     """
 
+    # Seconds after which a wave that has not finished is given up.
+    timeout = 30.0
+
     def __init__(self, node: SensorNode, messenger: PeerMessenger, log):
         self.node = node
         self.msg = messenger
         self.log = log
         self.waves_sent = 0
-        self.ongoing_waves: dict[tuple[tuple[int, int], int], Wave] = {}
-
-    def start_echo_wave(self, operation=sensor.OP_NOOP):
+        self.incarnation = randint(1, 2**31 - 1)
+        self.ongoing_waves: dict[
+            tuple[tuple[int, int], int, int], Wave
+        ] = {}
+        self.completed = CompletedWaves()
+        self._on_decide = {}
+
+    def start_echo_wave(
+        self,
+        operation=sensor.OP_NOOP,
+        window=0,
+        on_decide=None,
+        setting=0,
+        value=0,
+    ):
         """
         Starts an echo wave propagation algorithm that will travel the
         network and return information about network structure.
 
         Args:
             operation (int): The type of wave operation to perform.
+            window (float): Length in seconds of the reading window for the
+                mean, min and max operations.
+            on_decide (callable | None): Called with a dict holding the
+                outcome when the wave decides.
+            setting (int): The setting a configuration wave changes.
+            value (float): The new value of the setting.
+
+        Returns:
+            int: The sequence number of the wave.
         """
 
+        sequence_number = self.waves_sent
+        if on_decide is not None:
+            self._on_decide[sequence_number] = on_decide
+
         children = set(self.node.neighbours.keys())
         origin = self.node.position
         print(f"{origin} - Initiating echo wave.")
 
-        self.ongoing_waves[(origin, self.waves_sent)] = Wave(
-            parent=None, children_waiting=children, operation=operation
+        wave = Wave(
+            parent=None,
+            children_waiting=children,
+            operation=operation,
+            window=window,
         )
+        self._contribute(wave)
+        key = (origin, self.incarnation, self.waves_sent)
+        self.ongoing_waves[key] = wave
 
-        if not children:
-            if operation == sensor.OP_SIZE:
-                self.log("size=1")
-            else:
-                self.log(f"The wave {self.waves_sent} has decided.")
-
-            del self.ongoing_waves[(origin, self.waves_sent)]
-
+        # The echo payload carries the reading window or the new value of a
+        # setting down the tree.
+        payload = value if operation == sensor.OP_CONFIG else window
         for neighbour in self.node.neighbours.values():
             self.msg.send_echo(
                 (neighbour.ip, neighbour.port),
@@ -553,9 +2107,25 @@ class EchoWaveController:
                 origin,
                 self.node.strength,
                 operation,
+                payload,
+                setting,
+                self.incarnation,
             )
 
+        # Settings are applied after the fan-out, because a new strength can
+        # remove neighbours that are already waited for.
+        if operation == sensor.OP_CONFIG:
+            self._apply_setting(wave, setting, value)
+
+        if not children:
+            self._decide(self.waves_sent, wave)
+            self._finish(key)
+
         self.waves_sent += 1
+        if self.node.snapshot is not None:
+            self.node.snapshot.store_sequence(self.waves_sent)
+
+        return sequence_number
 
     def handle_echo(self, decoded_message, address):
         """
@@ -572,59 +2142,73 @@ class EchoWaveController:
         sequence_number = decoded_message[1]
         initiator_position = decoded_message[2]
         sender_position = decoded_message[3]
+        setting, incarnation = decoded_message[4]
         operation = decoded_message[5]
+        payload = decoded_message[7]
 
         origin = self.node.position
+        key = (initiator_position, incarnation, sequence_number)
 
         # Check if we've already seen this wave.
-        if (initiator_position, sequence_number) not in self.ongoing_waves:
+        if key not in self.ongoing_waves and key not in self.completed:
             print(f"{origin} - Not seen this wave.")
             children = set(self.node.neighbours.keys()) - {sender_position}
 
             # Add wave to state.
-            self.ongoing_waves[(initiator_position, sequence_number)] = Wave(
+            wave = Wave(
                 parent=sender_position,
+                parent_address=address,
                 children_waiting=children,
                 operation=operation,
+                window=payload,
             )
+            self._contribute(wave)
+            self.ongoing_waves[key] = wave
             print(f"{origin} - Added wave to state.")
 
-            # No children (leaf node), ECHO_REPLY immediately.
-            if not children:
-                print(f"{origin} - No children.")
-                parent_address = (
-                    self.node.neighbours[sender_position].ip,
-                    self.node.neighbours[sender_position].port,
-                )
-
-                self.msg.send_echo_reply(
-                    parent_address,
+            # Forward ECHO message to children only.
+            for child_position in children:
+                print(f"{origin} - Sent echo messages to children.")
+                child = self.node.neighbours[child_position]
+                self.msg.send_echo(
+                    (child.ip, child.port),
                     initiator_position,
                     sequence_number,
                     origin,
                     self.node.strength,
                     operation,
-                    1 if operation == sensor.OP_SIZE else 0,
+                    payload,
+                    setting,
+                    incarnation,
                 )
 
-                return
+            # Settings are applied after forwarding, because a new strength
+            # can remove the neighbours we just forwarded to.
+            if operation == sensor.OP_CONFIG:
+                self._apply_setting(wave, setting, payload)
 
-            # Forward ECHO message to children only.
-            for child_position in children:
-                print(f"{origin} - Sent echo messages to children.")
-                child = self.node.neighbours[child_position]
-                self.msg.send_echo(
-                    (child.ip, child.port),
+            # No children (leaf node), ECHO_REPLY immediately.
+            if not children:
+                print(f"{origin} - No children.")
+                self.msg.send_echo_reply(
+                    address,
                     initiator_position,
                     sequence_number,
                     origin,
                     self.node.strength,
                     operation,
+                    wave.payload_sum,
+                    wave.payload_count,
+                    wave.acks,
+                    incarnation,
                 )
+                self._finish(key)
 
             return
 
-        # Already participating in wave, send ECHO_REPLY.
+        # Already participating in or done with the wave, send ECHO_REPLY that
+        # does not change the aggregate. The sender counts on a reply, so a
+        # late ECHO for a completed wave is answered rather than dropped.
         self.msg.send_echo_reply(
             address,
             initiator_position,
@@ -632,13 +2216,15 @@ class EchoWaveController:
             origin,
             self.node.strength,
             operation,
+            self._neutral_payload(operation),
+            incarnation=incarnation,
         )
         print(f"{origin} - Already participating in wave, sent echo reply.")
 
     def handle_echo_reply(self, decoded_message):
         """
         Process an incoming ECHO_REPLY message and propagate the wave.
-        Also accumulates payload data for size calculations, and forwards
+        Also accumulates payload data for aggregating operations, and forwards
         replies up the wave tree until reaching the origin node.
 
         Args:
@@ -647,44 +2233,469 @@ class EchoWaveController:
         sequence_number = decoded_message[1]
         initiator_position = decoded_message[2]
         sender_position = decoded_message[3]
+        count, incarnation = decoded_message[4]
         operation = decoded_message[5]
         payload = decoded_message[7]
+        trailer = decoded_message[8]
 
-        wave = self.ongoing_waves[(initiator_position, sequence_number)]
+        key = (initiator_position, incarnation, sequence_number)
+        wave = self.ongoing_waves.get(key)
+        if wave is None:
+            # Late or duplicated reply for a wave that already completed.
+            print(f"{self.node.position} - Dropped reply for unknown wave.")
+            return
         wave.children_waiting.discard(sender_position)
 
-        wave.payload_sum += payload if operation == sensor.OP_SIZE else 0
-        upstream_payload = wave.payload_sum + 1
+        if operation == sensor.OP_MIN:
+            wave.payload_sum = min(wave.payload_sum, payload)
+        elif operation == sensor.OP_MAX:
+            wave.payload_sum = max(wave.payload_sum, payload)
+        elif operation in (sensor.OP_SIZE, sensor.OP_MEAN):
+            wave.payload_sum += payload
+            wave.payload_count += count
+        elif operation == sensor.OP_CONFIG:
+            wave.payload_count += count
+            wave.acks += sensor.positions_decode(trailer)
 
         # Check if children waiting set is empty
         if not wave.children_waiting:
             if wave.parent is None:
-                if operation == sensor.OP_SIZE:
-                    self.log(f"size={upstream_payload}")
-                else:
-                    self.log(f"The wave {sequence_number} has decided.")
+                self._decide(sequence_number, wave)
             else:
                 self.log(
                     f"{(sequence_number, initiator_position)}: Received from all neighbours."
                 )
 
-                parent_position = wave.parent
-                parent_address = (
-                    self.node.neighbours[parent_position].ip,
-                    self.node.neighbours[parent_position].port,
-                )
-
                 self.msg.send_echo_reply(
-                    parent_address,
+                    wave.parent_address,
                     initiator_position,
                     sequence_number,
                     self.node.position,
                     self.node.strength,
                     operation,
-                    upstream_payload if operation == sensor.OP_SIZE else 0,
+                    wave.payload_sum,
+                    wave.payload_count,
+                    wave.acks,
+                    incarnation,
                 )
 
-            del self.ongoing_waves[(initiator_position, sequence_number)]
+            self._finish(key)
+
+    def expire(self, now):
+        """Give up the waves that have been waiting longer than timeout."""
+
+        for key, wave in list(self.ongoing_waves.items()):
+            if now - wave.started_at <= self.timeout:
+                continue
+
+            self._finish(key)
+            if wave.parent is not None:
+                continue
+            sequence_number = key[2]
+            self.log(f"The wave {sequence_number} timed out.")
+            on_decide = self._on_decide.pop(sequence_number, None)
+            if on_decide is not None:
+                on_decide({"wave": sequence_number, "error": "wave timed out"})
+
+    def _finish(self, key):
+        """Move a wave from the ongoing waves to the completed ones."""
+
+        del self.ongoing_waves[key]
+        self.completed.add(key)
+
+    def _contribute(self, wave):
+        """Seed the aggregate of a new wave with this node's own share."""
+
+        if wave.operation == sensor.OP_SIZE:
+            wave.payload_sum = 1
+            return
+        aggregates = (sensor.OP_MEAN, sensor.OP_MIN, sensor.OP_MAX)
+        if wave.operation not in aggregates:
+            return
+
+        stats = self.node.readings.window(wave.window)
+        if wave.operation == sensor.OP_MEAN:
+            if stats is not None:
+                wave.payload_sum = stats.mean
+                wave.payload_count = 1
+        elif wave.operation == sensor.OP_MIN:
+            wave.payload_sum = stats.minimum if stats else math.inf
+        else:
+            wave.payload_sum = stats.maximum if stats else -math.inf
+
+    def _apply_setting(self, wave, setting, value):
+        """Apply the setting of a configuration wave and acknowledge it in
+        the wave if that worked."""
+
+        try:
+            self.node.apply_setting(setting, value)
+        except CommandError as e:
+            self.log(f"Error: configuration not applied ({e})")
+            return
+
+        wave.acks.append(self.node.position)
+        wave.payload_count += 1
+
+    def _neutral_payload(self, operation):
+        """Return the payload that leaves an aggregate unchanged."""
+
+        if operation == sensor.OP_MIN:
+            return math.inf
+        if operation == sensor.OP_MAX:
+            return -math.inf
+        return 0
+
+    def _decide(self, sequence_number, wave):
+        """Report the outcome of a wave that this node initiated."""
+
+        result = {"wave": sequence_number}
+        if wave.operation == sensor.OP_SIZE:
+            result["size"] = int(wave.payload_sum)
+            self.log(f"size={result['size']}")
+        elif wave.operation == sensor.OP_MEAN:
+            result["mean"] = None
+            result["count"] = wave.payload_count
+            if wave.payload_count:
+                result["mean"] = wave.payload_sum / wave.payload_count
+                self.log(f"mean={result['mean']} (n={wave.payload_count})")
+            else:
+                self.log("mean=n/a (no readings in window)")
+        elif wave.operation in (sensor.OP_MIN, sensor.OP_MAX):
+            name = "min" if wave.operation == sensor.OP_MIN else "max"
+            result[name] = None
+            if math.isinf(wave.payload_sum):
+                self.log(f"{name}=n/a (no readings in window)")
+            else:
+                result[name] = wave.payload_sum
+                self.log(f"{name}={wave.payload_sum}")
+        elif wave.operation == sensor.OP_CONFIG:
+            result["applied"] = wave.payload_count
+            result["nodes"] = wave.acks
+            nodes = " ".join(str(position) for position in wave.acks)
+            self.log(f"config applied on {wave.payload_count} nodes: {nodes}")
+        else:
+            self.log(f"The wave {sequence_number} has decided.")
+
+        on_decide = self._on_decide.pop(sequence_number, None)
+        if on_decide is not None:
+            on_decide(result)
+
+
+class ControlServer:
+    """
+    Local TCP control socket that lets scripts drive a node.
+
+    The protocol is JSON lines. Each line holds one request object, e.g.
+    {"id": 1, "cmd": "move", "args": [10, 20]}, or a JSON array of request
+    objects that are run in order. Every request gets exactly one response
+    line, {"id": 1, "ok": true, "result": ...} or {"id": 1, "ok": false,
+    "error": "..."}. Wave commands respond when the wave decides, with the
+    outcome of the wave as result, so responses can arrive out of order and
+    should be matched on id. A wave that times out responds with an error.
+
+    Attributes:
+        port (int): Port to listen on, 0 for a random port.
+        execute (callable): Runs a command, see SensorNode.execute.
+        _sock (socket.socket | None): The listening socket.
+        _inbox (dict[socket.socket, bytearray]): Unprocessed input per client.
+        _outbox (dict[socket.socket, bytearray]): Unsent output per client.
+    """
+
+    def __init__(self, port, execute):
+        self.port = port
+        self.execute = execute
+        self._sock = None
+        self._inbox = {}
+        self._outbox = {}
+
+    def start(self):
+        """Bind the listening socket to localhost."""
+
+        self._sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._sock.bind(("127.0.0.1", self.port))
+        self._sock.listen()
+        self._sock.setblocking(False)
+
+    def get_address(self):
+        return self._sock.getsockname()
+
+    @property
+    def read_sockets(self):
+        return [self._sock, *self._inbox]
+
+    @property
+    def write_sockets(self):
+        return [sock for sock, data in self._outbox.items() if data]
+
+    def handle(self, readable, writable):
+        """
+        Accept new clients, run the requests of complete lines and send
+        pending responses.
+
+        Args:
+            readable (list[socket.socket]): Sockets that select() reported
+                as readable, sockets that are not ours are ignored.
+            writable (list[socket.socket]): Sockets reported as writable.
+        """
+
+        for sock in writable:
+            if sock in self._outbox:
+                self._flush(sock)
+
+        for sock in readable:
+            if sock is self._sock:
+                try:
+                    client, _ = self._sock.accept()
+                except OSError:
+                    # The client gave up before we accepted it.
+                    continue
+                client.setblocking(False)
+                self._inbox[client] = bytearray()
+                self._outbox[client] = bytearray()
+            elif sock in self._inbox:
+                self._receive(sock)
+
+    def _receive(self, sock):
+        try:
+            data = sock.recv(65536)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError:
+            data = b""
+
+        if not data:
+            self._close(sock)
+            return
+
+        inbox = self._inbox[sock]
+        inbox += data
+        while sock in self._inbox:
+            end = inbox.find(b"\n")
+            if end < 0:
+                break
+            line = bytes(inbox[:end])
+            del inbox[: end + 1]
+            if line.strip():
+                self._handle_line(sock, line)
+
+    def _handle_line(self, sock, line):
+        try:
+            requests = json.loads(line)
+        except ValueError:
+            self._respond(sock, {"id": None, "ok": False, "error": "bad JSON"})
+            return
+
+        if not isinstance(requests, list):
+            requests = [requests]
+        for request in requests:
+            self._handle_request(sock, request)
+
+    def _handle_request(self, sock, request):
+        if not isinstance(request, dict) or "cmd" not in request:
+            self._respond(
+                sock, {"id": None, "ok": False, "error": "missing cmd"}
+            )
+            return
+
+        request_id = request.get("id")
+        args = request.get("args", [])
+        if not isinstance(args, list):
+            response = {
+                "id": request_id,
+                "ok": False,
+                "error": "args must be a list",
+            }
+            self._respond(sock, response)
+            return
+        parts = [str(request["cmd"])] + [str(arg) for arg in args]
+
+        def on_wave(result):
+            if "error" in result:
+                response = {
+                    "id": request_id,
+                    "ok": False,
+                    "error": result["error"],
+                }
+            else:
+                response = {"id": request_id, "ok": True, "result": result}
+            self._respond(sock, response)
+
+        try:
+            result = self.execute(parts, on_wave)
+        except CommandError as e:
+            response = {"id": request_id, "ok": False, "error": str(e)}
+            self._respond(sock, response)
+            return
+        except Exception as e:
+            response = {"id": request_id, "ok": False, "error": repr(e)}
+            self._respond(sock, response)
+            return
+
+        if parts[0].lower() not in SensorNode.WAVE_COMMANDS:
+            response = {"id": request_id, "ok": True, "result": result}
+            self._respond(sock, response)
+
+    def _respond(self, sock, response):
+        # The client may have disconnected before its wave decided.
+        if sock not in self._outbox:
+            return
+        self._outbox[sock] += json.dumps(response).encode() + b"\n"
+        self._flush(sock)
+
+    def _flush(self, sock):
+        outbox = self._outbox[sock]
+        try:
+            sent = sock.send(outbox)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError:
+            self._close(sock)
+            return
+        del outbox[:sent]
+
+    def _close(self, sock):
+        self._inbox.pop(sock, None)
+        self._outbox.pop(sock, None)
+        sock.close()
+
+
+class ReplaySession:
+    """
+    One run of a captured node, replayed on an offline SensorNode.
+
+    The node follows the positions and strengths recorded in the capture.
+    Its outgoing messages go to an OfflineSocket, and its periodic pings and
+    neighbour expiry are off, so only the captured traffic drives it.
+
+    Attributes:
+        node (SensorNode): The offline node.
+        speed (float): Replay speed relative to the original timing, 0 to
+            replay as fast as possible.
+        replayed (int): Number of datagrams fed to the node.
+    """
+
+    def __init__(self, position, strength, speed=1.0, profile_every=1):
+        self.node = SensorNode(
+            ("224.1.1.1", 50000),
+            position,
+            strength,
+            20.0,
+            0,
+            2**15,
+            sample_period=0,
+            profile_every=profile_every,
+        )
+        self.node.peer_messenger.start_offline()
+        self.node.ip, self.node.port = self.node.peer_messenger.get_address()
+        self.node.wave_controller = EchoWaveController(
+            self.node, self.node.peer_messenger, self.node.log
+        )
+        self.speed = speed
+        self.replayed = 0
+        self._first_timestamp = None
+        self._started = time.perf_counter()
+
+    def follow(self, position, strength):
+        """Apply a recorded move or strength change."""
+
+        node = self.node
+        if (position, strength) == (node.position, node.strength):
+            return
+        old_position = node.position
+        node.position = position
+        node.strength = strength
+        node._revalidate(old_position)
+
+    def feed(self, timestamp, channel, address, data):
+        """Hand a received datagram to the node once it is due."""
+
+        if self._first_timestamp is None:
+            self._first_timestamp = timestamp
+        if self.speed > 0:
+            offset = (timestamp - self._first_timestamp) / self.speed
+            delay = self._started + offset - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+
+        node = self.node
+        node.profiler.next_pass()
+        try:
+            message = node.profiler.call(
+                "receive", sensor.message_decode, data
+            )
+        except Exception:
+            return
+        dispatch = node._dispatch_peer
+        if channel == TrafficRecorder.MULTICAST:
+            dispatch = node._dispatch_multicast
+        node._dispatch(dispatch, message, address)
+        self.replayed += 1
+
+    def report(self):
+        """Print the log of the node, what it sent and its profile."""
+
+        node = self.node
+        while not node._log_lines.empty():
+            print(node._log_lines.get())
+
+        elapsed = time.perf_counter() - self._started
+        offline = node.peer_messenger.socket
+        print(
+            f"replayed {self.replayed} datagrams in {elapsed:.2f}s, "
+            f"node sent {offline.sent} ({offline.sent_bytes} bytes)"
+        )
+        for line in node._format_result("profile", node.profiler.summary()):
+            print(line)
+
+
+def replay_capture(path, speed=1.0, profile_every=1):
+    """
+    Feed the received datagrams of a capture into an offline SensorNode and
+    print the profile of its message handling.
+
+    Every run of the node in the capture is replayed as a session of its
+    own, on a new node and with its own timing, see ReplaySession.
+
+    Args:
+        path (str): Capture file written with --capture.
+        speed (float): Replay speed relative to the original timing, 0 to
+            replay as fast as possible.
+        profile_every (int): Time one in this many datagrams.
+
+    Returns:
+        int: The number of sessions replayed.
+    """
+
+    session = None
+    sessions = 0
+
+    for timestamp, direction, channel, address, data in TrafficRecorder.read(
+        path
+    ):
+        # A NODE record can only start a run if the START record is missing.
+        new_run = direction == TrafficRecorder.START or (
+            direction == TrafficRecorder.NODE and session is None
+        )
+        if new_run:
+            if session is not None:
+                session.report()
+            sessions += 1
+            position, strength = data
+            print(f"run {sessions} of the node at {position}")
+            session = ReplaySession(position, strength, speed, profile_every)
+        elif session is None:
+            continue
+        elif direction == TrafficRecorder.NODE:
+            session.follow(*data)
+        elif direction == TrafficRecorder.IN:
+            session.feed(timestamp, channel, address, data)
+
+    if session is None:
+        print("capture holds no node records")
+    else:
+        session.report()
+    return sessions
 
 
 # Additional parameters to this function must always have a default value.
@@ -695,6 +2706,16 @@ def main(
     sensor_value,
     grid_size,
     ping_period,
+    sample_period=1,
+    history_size=3600,
+    snapshot_path=None,
+    cell_size=0,
+    control_port=None,
+    send_rate=0,
+    total_send_rate=0,
+    profile_every=0,
+    cprofile_path=None,
+    capture_path=None,
 ):
     """
     mcast_addr: udp multicast (ip, port) tuple.
@@ -703,6 +2724,19 @@ def main(
     sensor_value: initial temperature measurement of the sensor.
     grid_size: length of the grid (which is always square).
     ping_period: time in seconds between multicast pings.
+    sample_period: time in seconds between readings of the sensor value.
+    history_size: number of readings kept in the reading history.
+    snapshot_path: file used to persist state across restarts (None=off).
+    cell_size: side of the grid cells that get their own multicast group
+        (0=use a single group).
+    control_port: localhost TCP port for the control socket (None=off,
+        0=random port).
+    send_rate: messages per second to a single peer (0=unlimited).
+    total_send_rate: messages per second to all peers (0=unlimited).
+    profile_every: time one in this many event loop passes (0=off).
+    cprofile_path: file for cProfile statistics of the network thread
+        (None=off).
+    capture_path: file that all datagrams are appended to (None=off).
     """
 
     new_sensor = SensorNode(
@@ -712,6 +2746,16 @@ def main(
         sensor_value,
         ping_period,
         grid_size,
+        sample_period,
+        history_size,
+        snapshot_path,
+        cell_size,
+        control_port,
+        send_rate,
+        total_send_rate,
+        profile_every,
+        cprofile_path,
+        capture_path,
     )
 
     new_sensor.start()
@@ -738,11 +2782,97 @@ if __name__ == "__main__":
         default=10,
         type=int,
     )
+    p.add_argument(
+        "--sample",
+        help="period between sensor readings (0=off)",
+        default=1,
+        type=float,
+    )
+    p.add_argument(
+        "--history",
+        help="number of readings kept in the history",
+        default=3600,
+        type=int,
+    )
+    p.add_argument(
+        "--snapshot", help="file for warm restart state", type=str
+    )
+    p.add_argument(
+        "--cell",
+        help="cell size for per-cell multicast groups (0=single group)",
+        default=0,
+        type=int,
+    )
+    p.add_argument(
+        "--control",
+        help="localhost port for the JSON control socket (0=random)",
+        type=int,
+    )
+    p.add_argument(
+        "--rate",
+        help="messages per second to a single peer (0=unlimited)",
+        default=0,
+        type=float,
+    )
+    p.add_argument(
+        "--total-rate",
+        help="messages per second to all peers (0=unlimited)",
+        default=0,
+        type=float,
+    )
+    p.add_argument(
+        "--profile",
+        help="time one in N event loop passes (0=off)",
+        default=0,
+        type=int,
+    )
+    p.add_argument(
+        "--cprofile",
+        help="write cProfile stats of the network thread to this file",
+        type=str,
+    )
+    p.add_argument(
+        "--capture", help="append all datagrams to this file", type=str
+    )
+    p.add_argument(
+        "--replay",
+        help="replay a capture file offline and print its profile",
+        type=str,
+    )
+    p.add_argument(
+        "--speed",
+        help="replay speed factor (0=as fast as possible)",
+        default=1,
+        type=float,
+    )
     args = p.parse_args(sys.argv[1:])
+    if args.history < 1:
+        p.error("--history must be at least 1")
+    if args.replay:
+        replay_capture(args.replay, args.speed, args.profile or 1)
+        sys.exit(0)
+
     if args.pos:
         pos = tuple(int(n) for n in args.pos.split(",")[:2])
     else:
         pos = random_position(args.grid)
     value = args.value if args.value is not None else gauss(20, 2)
     mcast_addr = (args.group, args.port)
-    main(mcast_addr, pos, args.strength, value, args.grid, args.period)
+    main(
+        mcast_addr,
+        pos,
+        args.strength,
+        value,
+        args.grid,
+        args.period,
+        args.sample,
+        args.history,
+        args.snapshot,
+        args.cell,
+        args.control,
+        args.rate,
+        args.total_rate,
+        args.profile,
+        args.cprofile,
+        args.capture,
+    )
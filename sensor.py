@@ -16,12 +16,21 @@ MSG_PING = 0  # Multicast ping.
 MSG_PONG = 1  # Unicast pong.
 MSG_ECHO = 2  # Unicast echo.
 MSG_ECHO_REPLY = 3  # Unicast echo reply.
+MSG_ANNOUNCE = 4  # Multicast position or strength change.
 # TODO: You may define your own message types if needed.
 
 # These are the echo operations.
 OP_NOOP = 0  # Do nothing.
 OP_SIZE = 1  # Compute the size of network.
 OP_UPDATE = 2  # Force update the network.
+OP_MEAN = 3  # Mean of the recent readings of all nodes.
+OP_MIN = 4  # Minimum of the recent readings of all nodes.
+OP_MAX = 5  # Maximum of the recent readings of all nodes.
+OP_CONFIG = 6  # Apply a setting on all nodes.
+
+# These are the settings a configuration wave can change.
+CFG_STRENGTH = 1  # Signal strength.
+CFG_PERIOD = 2  # Seconds between pings.
 
 # This is used to pack message fields into a binary format.
 message_format = struct.Struct("!iiiiiiiiiif")
@@ -29,6 +38,13 @@ message_format = struct.Struct("!iiiiiiiiiif")
 # Length of a message in bytes.
 message_length = message_format.size
 
+# Format of the positions that may follow a message.
+position_format = struct.Struct("!ii")
+
+# Largest UDP payload, and the number of positions that fit in a message.
+max_datagram = 65507
+max_positions = (max_datagram - message_length) // position_format.size
+
 
 def message_encode(
     type,
@@ -39,6 +55,7 @@ def message_encode(
     operation=0,
     strength=0,
     payload=0,
+    trailer=b"",
 ):
     """
     Encodes message fields into a binary format.
@@ -49,24 +66,29 @@ def message_encode(
     operation: The echo operation.
     strength: The strength of initiator
     payload: Echo operation data (a number and a decaying rate).
+    trailer: Extra bytes appended to the message.
     Returns: A binary string in which all parameters are packed.
     """
     ix, iy = initiator
     nx, ny = neighbor
     tx, ty = target
-    return message_format.pack(
+    message = message_format.pack(
         type, sequence, ix, iy, nx, ny, tx, ty, operation, strength, payload
     )
+    return message + trailer
 
 
 def message_decode(buffer):
     """
     Decodes a binary message string to Python objects.
     buffer: The binary string to decode.
-    Returns: A tuple containing all the unpacked message fields.
+    Returns: A tuple containing all the unpacked message fields, followed
+        by the bytes after the fields.
     """
+    if len(buffer) < message_length:
+        raise struct.error("message too short")
     type, sequence, ix, iy, nx, ny, tx, ty, operation, strength, payload = (
-        message_format.unpack(buffer)
+        message_format.unpack_from(buffer)
     )
     return (
         type,
@@ -77,4 +99,20 @@ def message_decode(buffer):
         operation,
         strength,
         payload,
+        buffer[message_length:],
     )
+
+
+def positions_encode(positions):
+    """
+    Encodes a list of (x, y) positions for use as a message trailer.
+    """
+    return b"".join(position_format.pack(x, y) for x, y in positions)
+
+
+def positions_decode(buffer):
+    """
+    Decodes a trailer made by positions_encode to a list of (x, y) tuples.
+    """
+    usable = len(buffer) - len(buffer) % position_format.size
+    return list(position_format.iter_unpack(buffer[:usable]))
@@ -0,0 +1,782 @@
+"""
+Unit tests for the data structures and wave logic of lab5.
+
+Run with: python -m unittest (or python -m pytest).
+"""
+
+import collections
+import contextlib
+import io
+import json
+import os
+import random
+import tempfile
+import threading
+import time
+import unittest
+import unittest.mock
+
+import lab5
+
+
+def make_node(position=(0, 0), strength=64, **kwargs):
+    """A node that is not started, so it has no sockets or GUI."""
+
+    return lab5.SensorNode(
+        ("224.1.1.1", 50000), position, strength, 20.0, 0, 128, **kwargs
+    )
+
+
+def start_offline(node):
+    """Give a node an offline socket and a wave controller."""
+
+    node.peer_messenger.start_offline()
+    node.ip, node.port = node.peer_messenger.get_address()
+    node.wave_controller = lab5.EchoWaveController(
+        node, node.peer_messenger, node.log
+    )
+    return node
+
+
+class FakeSocket:
+    """Peer socket that hands datagrams to a FakeNetwork."""
+
+    def __init__(self, network, address):
+        self.network = network
+        self.address = address
+
+    def sendto(self, data, address):
+        self.network.queue.append((self.address, address, data))
+
+    def getsockname(self):
+        return self.address
+
+
+class FakeNetwork:
+    """In-memory network of nodes that delivers datagrams in order.
+    Datagrams to the multicast group go to every other node."""
+
+    MCAST_ADDR = ("224.1.1.1", 50000)
+
+    def __init__(self):
+        self.queue = collections.deque()
+        self.nodes = {}
+
+    def add(self, position, port, strength=64):
+        node = make_node(position, strength)
+        address = ("127.0.0.1", port)
+        node.peer_messenger._sock = FakeSocket(self, address)
+        node.ip, node.port = address
+        node.wave_controller = lab5.EchoWaveController(
+            node, node.peer_messenger, node.log
+        )
+        self.nodes[address] = node
+        return node
+
+    def link(self, a, b):
+        distance = lab5.calculate_distance(a.position, b.position)
+        for node, other in ((a, b), (b, a)):
+            node.neighbours.update(
+                other.position,
+                other.ip,
+                other.port,
+                other.strength,
+                distance,
+                time.time(),
+            )
+
+    def run(self):
+        while self.queue:
+            source, destination, data = self.queue.popleft()
+            message = lab5.sensor.message_decode(data)
+            if destination == self.MCAST_ADDR:
+                for address, node in self.nodes.items():
+                    if address != source:
+                        node._dispatch_multicast(message, source)
+                continue
+            node = self.nodes.get(destination)
+            if node is not None:
+                node._dispatch_peer(message, source)
+
+
+class FakeClient:
+    """Control socket client that collects the responses."""
+
+    def __init__(self):
+        self.data = b""
+
+    def send(self, data):
+        self.data += bytes(data)
+        return len(data)
+
+    def responses(self):
+        return [json.loads(line) for line in self.data.splitlines()]
+
+
+class ReadingHistoryTest(unittest.TestCase):
+    def brute_force(self, readings, seconds, now):
+        values = [v for t, v in readings if t >= now - seconds]
+        if not values:
+            return None
+        return len(values), sum(values) / len(values), min(values), max(values)
+
+    def test_matches_brute_force(self):
+        rng = random.Random(1)
+        history = lab5.ReadingHistory(16)
+        readings = []
+        for t in range(50):
+            value = rng.uniform(-10, 10)
+            history.append(float(t), value)
+            readings = (readings + [(t, value)])[-16:]
+            for seconds in (0, 1, 5, 15, 16, 100):
+                stats = history.window(seconds, now=float(t))
+                expected = self.brute_force(readings, seconds, t)
+                if expected is None:
+                    self.assertIsNone(stats)
+                    continue
+                count, mean, low, high = expected
+                self.assertEqual(stats.count, count)
+                self.assertAlmostEqual(stats.mean, mean)
+                self.assertEqual(stats.minimum, low)
+                self.assertEqual(stats.maximum, high)
+
+    def test_empty_window(self):
+        history = lab5.ReadingHistory(4)
+        self.assertIsNone(history.window(60, now=0.0))
+        history.append(0.0, 1.0)
+        self.assertIsNone(history.window(10, now=100.0))
+
+    def test_capacity_must_be_positive(self):
+        for capacity in (0, -1):
+            with self.assertRaises(ValueError):
+                lab5.ReadingHistory(capacity)
+
+    def test_window_seconds_must_fit_payload(self):
+        node = make_node()
+        for text in ("1e40", "inf", "nan"):
+            with self.assertRaises(lab5.CommandError):
+                node.execute(["mean", text])
+
+
+class NodeSnapshotTest(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, "node.snap")
+
+    def test_round_trip(self):
+        table = lab5.NeighbourTable()
+        table.update((1, 0), "10.0.0.1", 5001, 64, 3.0, last_seen=0.0)
+        table.update((2, 0), "10.0.0.2", 5002, 32, 1.0, last_seen=0.0)
+
+        snapshot = lab5.NodeSnapshot(self.path)
+        self.assertEqual(snapshot.load(), (0, 0, []))
+        snapshot.store_port(5000)
+        snapshot.store_sequence(12)
+        snapshot.store_neighbours(table)
+        snapshot.close()
+
+        snapshot = lab5.NodeSnapshot(self.path)
+        self.assertEqual(
+            snapshot.load(),
+            (
+                12,
+                5000,
+                [
+                    ((2, 0), "10.0.0.2", 5002, 32),
+                    ((1, 0), "10.0.0.1", 5001, 64),
+                ],
+            ),
+        )
+        snapshot.close()
+
+    def test_keeps_closest_neighbours(self):
+        table = lab5.NeighbourTable()
+        for x in range(4):
+            table.update((x, 0), "10.0.0.1", 1, 64, 4.0 - x, last_seen=0.0)
+
+        snapshot = lab5.NodeSnapshot(self.path, capacity=2)
+        snapshot.store_neighbours(table)
+        stored = [position for position, *_ in snapshot.load()[2]]
+        snapshot.close()
+        self.assertEqual(stored, [(3, 0), (2, 0)])
+
+    def test_restored_neighbours_are_provisional(self):
+        node = make_node((0, 0), strength=10)
+        node._restore_neighbours(
+            [((3, 4), "10.0.0.1", 1, 64), ((30, 40), "10.0.0.2", 2, 64)]
+        )
+        self.assertEqual(list(node.neighbours.keys()), [(3, 4)])
+        self.assertTrue(node.neighbours[(3, 4)].provisional)
+
+
+class MulticastShardsTest(unittest.TestCase):
+    def setUp(self):
+        self.shards = lab5.MulticastShards("239.1.0.0", 50000, 16, 128)
+
+    def test_no_link_is_lost(self):
+        rng = random.Random(3)
+        for _ in range(3000):
+            a = (rng.randint(-40, 170), rng.randint(-40, 170))
+            b = (rng.randint(-40, 170), rng.randint(-40, 170))
+            strength_a, strength_b = rng.randint(0, 80), rng.randint(0, 80)
+            distance = lab5.calculate_distance(a, b)
+            if distance > min(strength_a, strength_b):
+                continue
+            # a must hear the pings of b, which go to the group of b's cell.
+            group, _ = self.shards.group_for(b)
+            self.assertIn(group, self.shards.groups_within(a, strength_a))
+
+    def test_edge_cells_hold_positions_off_the_grid(self):
+        ping_group, _ = self.shards.group_for((-20, 0))
+        self.assertEqual(ping_group, self.shards.group_for((0, 0))[0])
+        self.assertIn(ping_group, self.shards.groups_within((-70, 0), 64))
+        far_group, _ = self.shards.group_for((500, 500))
+        self.assertIn(far_group, self.shards.groups_within((200, 200), 20))
+
+    def test_only_cells_in_range(self):
+        groups = self.shards.groups_within((8, 8), 4)
+        self.assertEqual(groups, {self.shards.group_for((8, 8))[0]})
+
+    def test_move_rejects_positions_off_the_grid(self):
+        node = make_node()
+        for x, y in ((-1, 0), (0, -1), (129, 0)):
+            with self.assertRaises(lab5.CommandError):
+                node.execute(["move", str(x), str(y)])
+
+
+class RevalidateTest(unittest.TestCase):
+    def test_evicts_out_of_range_and_updates_distances(self):
+        node = start_offline(make_node((0, 0), strength=64))
+        now = time.time()
+        node.neighbours.update((10, 0), "10.0.0.1", 1, 64, 10.0, now)
+        node.neighbours.update((0, 60), "10.0.0.2", 2, 64, 60.0, now)
+        node.neighbours.update((70, 0), "10.0.0.3", 3, 20, 70.0, now)
+
+        old_position = node.position
+        node.position = (40, 0)
+        node._revalidate(old_position)
+
+        # (0, 60) is 72 away, (70, 0) is 30 away but only has strength 20.
+        self.assertEqual(list(node.neighbours.keys()), [(10, 0)])
+        self.assertEqual(node.neighbours[(10, 0)].distance, 30.0)
+        # The change is announced on the multicast group.
+        self.assertEqual(node.peer_messenger.socket.sent, 1)
+
+    def test_lower_strength_evicts_neighbours(self):
+        node = start_offline(make_node((0, 0), strength=64))
+        now = time.time()
+        node.neighbours.update((10, 0), "10.0.0.1", 1, 64, 10.0, now)
+        node.neighbours.update((50, 0), "10.0.0.2", 2, 64, 50.0, now)
+
+        node.execute(["strength", "20"])
+        self.assertEqual(list(node.neighbours.keys()), [(10, 0)])
+
+
+class AnnounceTest(unittest.TestCase):
+    def setUp(self):
+        self.network = FakeNetwork()
+        self.a = self.network.add((0, 0), 1)
+        self.b = self.network.add((10, 0), 2)
+        self.c = self.network.add((100, 0), 3)
+        self.network.link(self.a, self.b)
+
+    def test_moved_peer_replaces_old_entry(self):
+        self.b.execute(["move", "50", "0"])
+        self.network.run()
+
+        self.assertEqual(list(self.a.neighbours.keys()), [(50, 0)])
+        self.assertEqual(self.a.neighbours[(50, 0)].distance, 50.0)
+        # a and the new peer c answered the announce with a pong.
+        self.assertEqual(set(self.b.neighbours.keys()), {(0, 0), (100, 0)})
+        self.assertEqual(list(self.c.neighbours.keys()), [(50, 0)])
+
+    def test_peer_out_of_range_is_dropped(self):
+        self.b.execute(["move", "80", "0"])
+        self.network.run()
+
+        self.assertEqual(len(self.a.neighbours), 0)
+        self.assertEqual(list(self.b.neighbours.keys()), [(100, 0)])
+
+
+class NeighbourTableTest(unittest.TestCase):
+    def test_expire_removes_only_stale_neighbours(self):
+        table = lab5.NeighbourTable()
+        table.update((1, 0), "10.0.0.1", 1, 64, 1.0, last_seen=10.0)
+        table.update((2, 0), "10.0.0.2", 2, 64, 2.0, last_seen=20.0)
+        # Seen again, so the first heap entry of (1, 0) is outdated.
+        table.update((1, 0), "10.0.0.1", 1, 64, 1.0, last_seen=30.0)
+
+        self.assertEqual(table.expire(25.0), [(2, 0)])
+        self.assertEqual(list(table.keys()), [(1, 0)])
+        self.assertEqual(table.expire(25.0), [])
+        self.assertEqual(table.expire(31.0), [(1, 0)])
+        self.assertEqual(len(table), 0)
+
+    def test_by_distance_follows_changes(self):
+        table = lab5.NeighbourTable()
+        table.update((1, 0), "10.0.0.1", 1, 64, 5.0, last_seen=0.0)
+        table.update((2, 0), "10.0.0.2", 2, 64, 1.0, last_seen=0.0)
+        table.update((3, 0), "10.0.0.3", 3, 64, 3.0, last_seen=0.0)
+        table.set_distance((1, 0), 2.0)
+        table.discard((3, 0))
+
+        order = [position for position, _ in table.by_distance()]
+        self.assertEqual(order, [(2, 0), (1, 0)])
+        order = [position for position, _ in table.by_distance(True)]
+        self.assertEqual(order, [(1, 0), (2, 0)])
+
+    def test_matches_dict_model(self):
+        rng = random.Random(2)
+        table = lab5.NeighbourTable()
+        model = {}
+        now = 0.0
+        for _ in range(2000):
+            now += 1.0
+            position = (rng.randrange(20), 0)
+            action = rng.random()
+            if action < 0.6:
+                distance = float(rng.randrange(10))
+                port = rng.randrange(1, 1000)
+                table.update(position, "10.0.0.1", port, 64, distance, now)
+                model[position] = (port, distance, now)
+            elif action < 0.8:
+                table.discard(position)
+                model.pop(position, None)
+            else:
+                cutoff = now - rng.randrange(40)
+                expired = table.expire(cutoff)
+                stale = [p for p, row in model.items() if row[2] < cutoff]
+                self.assertCountEqual(expired, stale)
+                for p in stale:
+                    del model[p]
+
+            self.assertEqual(set(table.keys()), set(model))
+            for p, neighbour in table.items():
+                self.assertEqual(
+                    (neighbour.port, neighbour.distance, neighbour.last_seen),
+                    model[p],
+                )
+            distances = [n.distance for _, n in table.by_distance()]
+            self.assertEqual(distances, sorted(distances))
+            self.assertEqual(len(distances), len(model))
+
+
+class PeerMessengerFlushTest(unittest.TestCase):
+    A = ("10.0.0.1", 1)
+    B = ("10.0.0.2", 2)
+
+    def make_messenger(self, rate, total_rate=0):
+        messenger = lab5.PeerMessenger(rate=rate, total_rate=total_rate)
+        messenger.start_offline()
+        return messenger
+
+    def send(self, messenger, name, address):
+        messenger._send(name, address, messenger.PRIORITY_WAVE)
+
+    def lane(self, messenger):
+        return list(messenger._lanes[messenger.PRIORITY_WAVE])
+
+    def test_keeps_order_when_total_runs_out(self):
+        messenger = self.make_messenger(rate=1, total_rate=1)
+        messenger._bucket(self.A, time.time()).tokens = 0
+        self.send(messenger, b"a1", self.A)
+        self.send(messenger, b"b1", self.B)
+        self.send(messenger, b"a2", self.A)
+
+        messenger.flush()
+        self.assertEqual(messenger.socket.sent, 1)
+        self.assertEqual(
+            self.lane(messenger), [(b"a1", self.A), (b"a2", self.A)]
+        )
+
+    def test_blocked_destination_does_not_hold_up_others(self):
+        messenger = self.make_messenger(rate=1)
+        messenger._bucket(self.A, time.time()).tokens = 0
+        self.send(messenger, b"a1", self.A)
+        self.send(messenger, b"b1", self.B)
+        self.send(messenger, b"a2", self.A)
+        self.send(messenger, b"b2", self.B)
+
+        messenger.flush()
+        self.assertEqual(messenger.socket.sent, 1)
+        self.assertEqual(
+            self.lane(messenger),
+            [(b"a1", self.A), (b"a2", self.A), (b"b2", self.B)],
+        )
+
+    def test_idle_buckets_are_pruned(self):
+        messenger = self.make_messenger(rate=5)
+        idle_since = time.time() - 1.2
+        for port in range(1101):
+            bucket = messenger._bucket(("10.0.0.3", port), idle_since)
+            bucket.tokens = 0
+
+        self.send(messenger, b"b1", self.B)
+        messenger.flush()
+        self.assertEqual(messenger.socket.sent, 1)
+        self.assertEqual(list(messenger._buckets), [self.B])
+
+
+class CompletedWavesTest(unittest.TestCase):
+    def test_forgets_oldest(self):
+        completed = lab5.CompletedWaves(capacity=2)
+        for sequence_number in range(3):
+            completed.add(((1, 2), 7, sequence_number))
+        completed.add(((1, 2), 7, 2))
+
+        self.assertEqual(len(completed), 2)
+        self.assertNotIn(((1, 2), 7, 0), completed)
+        self.assertIn(((1, 2), 7, 1), completed)
+        self.assertIn(((1, 2), 7, 2), completed)
+
+    def test_ids_differ_in_every_field(self):
+        completed = lab5.CompletedWaves()
+        completed.add(((-1, 2), 7, 3))
+        self.assertIn(((-1, 2), 7, 3), completed)
+        for key in (((1, 2), 7, 3), ((-1, 3), 7, 3), ((-1, 2), 8, 3)):
+            self.assertNotIn(key, completed)
+        self.assertNotIn(((-1, 2), 7, 4), completed)
+
+
+class EchoWaveTest(unittest.TestCase):
+    def setUp(self):
+        self.network = FakeNetwork()
+        self.a = self.network.add((0, 0), 1)
+        self.b = self.network.add((10, 0), 2)
+        self.c = self.network.add((20, 0), 3)
+        self.network.link(self.a, self.b)
+        self.network.link(self.b, self.c)
+
+    def size(self, node):
+        results = []
+        node.execute(["size"], on_wave=results.append)
+        self.network.run()
+        [result] = results
+        return result["size"]
+
+    def test_size_of_chain(self):
+        self.assertEqual(self.size(self.a), 3)
+        self.assertEqual(self.size(self.c), 3)
+        for node in self.network.nodes.values():
+            self.assertEqual(node.wave_controller.ongoing_waves, {})
+
+    def test_late_echo_gets_neutral_reply(self):
+        self.assertEqual(self.size(self.a), 3)
+        # Replay the first echo of the wave to b after it completed.
+        controller = self.a.wave_controller
+        self.a.peer_messenger.send_echo(
+            (self.b.ip, self.b.port),
+            self.a.position,
+            0,
+            self.a.position,
+            self.a.strength,
+            lab5.sensor.OP_SIZE,
+            incarnation=controller.incarnation,
+        )
+        self.network.run()
+        self.assertEqual(self.b.wave_controller.ongoing_waves, {})
+        self.assertEqual(self.size(self.a), 3)
+
+    def test_restarted_initiator_reuses_sequence_numbers(self):
+        self.assertEqual(self.size(self.a), 3)
+
+        # Restart a without a snapshot, so its sequence numbers start at 0
+        # again.
+        restarted = self.network.add(self.a.position, self.a.port)
+        self.network.link(restarted, self.b)
+        self.assertEqual(restarted.wave_controller.waves_sent, 0)
+        self.assertEqual(self.size(restarted), 3)
+
+
+class ConfigWaveTest(unittest.TestCase):
+    def test_rejects_values_that_cannot_be_pushed(self):
+        node = start_offline(make_node())
+        for setting, text in (
+            ("period", "0"),
+            ("period", "0.001"),
+            ("period", "-1"),
+            ("period", "1e40"),
+            ("period", "nan"),
+            ("strength", "0"),
+            ("strength", "1e10"),
+            ("strength", "1.5"),
+            ("strength", "-1"),
+        ):
+            with self.assertRaises(lab5.CommandError, msg=(setting, text)):
+                node.execute(["config", setting, text])
+        for text in ("0", "3000000000"):
+            with self.assertRaises(lab5.CommandError):
+                node.execute(["strength", text])
+
+    def test_every_node_applies_the_same_value(self):
+        network = FakeNetwork()
+        a = network.add((0, 0), 1)
+        b = network.add((10, 0), 2)
+        network.link(a, b)
+
+        results = []
+        a.execute(["config", "period", "1.1"], on_wave=results.append)
+        network.run()
+        [result] = results
+        self.assertEqual(result["applied"], 2)
+        self.assertNotEqual(a.ping_period, 1.1)
+        self.assertEqual(a.ping_period, b.ping_period)
+
+
+class LoopProfilerTest(unittest.TestCase):
+    def test_times_one_in_every_passes(self):
+        profiler = lab5.LoopProfiler(every=3)
+        timed = []
+        for _ in range(9):
+            timed.append(profiler.next_pass())
+            profiler.call("phase", lambda: None)
+        self.assertEqual(timed, [False, False, True] * 3)
+        [row] = profiler.summary()
+        self.assertEqual(row["phase"], "phase")
+        self.assertEqual(row["count"], 3)
+
+    def test_off_by_default(self):
+        profiler = lab5.LoopProfiler()
+        self.assertFalse(profiler.next_pass())
+        self.assertEqual(profiler.call("phase", max, 1, 2), 2)
+        self.assertEqual(profiler.summary(), [])
+
+    def test_threads_count_their_own_passes(self):
+        profiler = lab5.LoopProfiler(every=2)
+        profiler.next_pass()
+
+        other = []
+        thread = threading.Thread(
+            target=lambda: other.append(profiler.next_pass())
+        )
+        thread.start()
+        thread.join()
+
+        self.assertEqual(other, [False])
+        self.assertTrue(profiler.next_pass())
+
+    def test_summary_order_and_reset(self):
+        profiler = lab5.LoopProfiler(every=1)
+        profiler.record("short", 0.001)
+        profiler.record("long", 0.003)
+        profiler.record("short", 0.001)
+        profiler.record("short", 0.0005)
+
+        rows = profiler.summary()
+        self.assertEqual([row["phase"] for row in rows], ["long", "short"])
+        self.assertEqual(rows[1]["count"], 3)
+        self.assertAlmostEqual(rows[1]["total_ms"], 2.5)
+        self.assertAlmostEqual(rows[1]["max_us"], 1000.0)
+
+        profiler.reset()
+        self.assertEqual(profiler.summary(), [])
+
+
+class TrafficRecorderTest(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, "capture.bin")
+
+    def ping(self, position):
+        return lab5.sensor.message_encode(
+            lab5.sensor.MSG_PING, 0, position, position, strength=64
+        )
+
+    def test_round_trip(self):
+        recorder = lab5.TrafficRecorder(self.path)
+        recorder.record_start((1, 2), 64)
+        recorder.record(
+            recorder.IN, recorder.MULTICAST, ("10.0.0.1", 5000), b"ping"
+        )
+        recorder.record(recorder.OUT, recorder.PEER, ("10.0.0.2", 6000), b"")
+        recorder.record_node((3, 4), 32)
+        recorder.close()
+
+        records = [
+            record[1:] for record in lab5.TrafficRecorder.read(self.path)
+        ]
+        self.assertEqual(
+            records,
+            [
+                (recorder.START, recorder.PEER, ("0.0.0.0", 0), ((1, 2), 64)),
+                (
+                    recorder.IN,
+                    recorder.MULTICAST,
+                    ("10.0.0.1", 5000),
+                    b"ping",
+                ),
+                (recorder.OUT, recorder.PEER, ("10.0.0.2", 6000), b""),
+                (recorder.NODE, recorder.PEER, ("0.0.0.0", 0), ((3, 4), 32)),
+            ],
+        )
+
+    def test_truncated_record_is_skipped(self):
+        recorder = lab5.TrafficRecorder(self.path)
+        recorder.record_start((1, 2), 64)
+        recorder.record(recorder.IN, recorder.PEER, ("10.0.0.1", 1), b"x" * 8)
+        recorder.close()
+
+        size = os.path.getsize(self.path)
+        for cut in (3, 8 + 3):
+            with open(self.path, "r+b") as f:
+                f.truncate(size - cut)
+            records = list(lab5.TrafficRecorder.read(self.path))
+            self.assertEqual(len(records), 1)
+            self.assertEqual(records[0][1], recorder.START)
+
+    def test_replay_separates_runs(self):
+        now = time.time()
+        for start in (now, now + 3600):
+            with unittest.mock.patch.object(
+                lab5.time, "time", return_value=start
+            ):
+                recorder = lab5.TrafficRecorder(self.path)
+                recorder.record_start((0, 0), 64)
+                recorder.record(
+                    recorder.IN,
+                    recorder.MULTICAST,
+                    ("10.0.0.1", 5000),
+                    self.ping((10, 0)),
+                )
+                recorder.close()
+
+        output = io.StringIO()
+        started = time.perf_counter()
+        with contextlib.redirect_stdout(output):
+            sessions = lab5.replay_capture(self.path, speed=1)
+        self.assertLess(time.perf_counter() - started, 5)
+
+        self.assertEqual(sessions, 2)
+        # Every run answers the ping with a pong, and the second run is not
+        # taken for a move of the first.
+        reports = [
+            line
+            for line in output.getvalue().splitlines()
+            if line.startswith("replayed")
+        ]
+        self.assertEqual(len(reports), 2)
+        for line in reports:
+            self.assertIn("replayed 1 datagrams", line)
+            self.assertIn("node sent 1 ", line)
+
+
+class NetworkThreadErrorTest(unittest.TestCase):
+    def setUp(self):
+        self.node = start_offline(make_node())
+
+    def log_lines(self):
+        lines = []
+        while not self.node._log_lines.empty():
+            lines.append(self.node._log_lines.get())
+        return lines
+
+    def test_failing_handler_is_logged(self):
+        def fail(message, address):
+            raise ValueError("bad message")
+
+        self.node._dispatch(fail, (99,), ("10.0.0.1", 5))
+        [line] = self.log_lines()
+        self.assertIn("bad message", line)
+
+    def test_failing_command_is_logged(self):
+        def fail():
+            raise OSError("network is unreachable")
+
+        self.node._ping = fail
+        self.node._commands.put("ping")
+        self.node._handle_gui_commands()
+        [line] = self.log_lines()
+        self.assertIn("network is unreachable", line)
+
+    def test_failing_periodic_ping_is_logged(self):
+        socket = unittest.mock.Mock()
+        socket.sendto.side_effect = OSError(101, "Network is unreachable")
+        self.node.peer_messenger._sock = socket
+        self.node.ping_period = 10
+        self.node.next_ping_at = 0
+
+        self.node._periodic_ping()
+        [line] = self.log_lines()
+        self.assertIn("Network is unreachable", line)
+
+    def test_failing_paced_send_is_logged(self):
+        messenger = lab5.PeerMessenger(log=self.node.log, rate=10)
+        messenger._sock = unittest.mock.Mock()
+        messenger._sock.sendto.side_effect = OSError("no buffer space")
+        messenger.send_ping(("10.0.0.1", 1), (0, 0), (0, 0), 64)
+
+        messenger.flush()
+        self.assertEqual(messenger.pending, 0)
+        [line] = self.log_lines()
+        self.assertIn("no buffer space", line)
+
+    def test_failing_receive_is_logged(self):
+        socket = unittest.mock.Mock()
+        socket.recvfrom.side_effect = ConnectionRefusedError()
+        self.node.peer_messenger._sock = socket
+
+        self.assertEqual(self.node.peer_messenger.poll(), (None, None))
+        self.assertEqual(len(self.log_lines()), 1)
+
+    def test_dead_network_thread_stops_node(self):
+        def fail():
+            raise RuntimeError("bug")
+
+        self.node._handle_incoming_messages = fail
+        with unittest.mock.patch("traceback.print_exc"):
+            self.node._network_loop()
+        self.assertTrue(self.node._stop.is_set())
+        self.assertIn("bug", self.log_lines()[-1])
+
+
+class ControlServerTest(unittest.TestCase):
+    def setUp(self):
+        self.node = start_offline(make_node())
+        self.server = lab5.ControlServer(0, self.node.execute)
+        self.client = FakeClient()
+        self.server._inbox[self.client] = bytearray()
+        self.server._outbox[self.client] = bytearray()
+
+    def test_args_must_be_a_list(self):
+        line = b'{"id": 1, "cmd": "move", "args": 5}'
+        self.server._handle_line(self.client, line)
+        [response] = self.client.responses()
+        self.assertEqual(response["id"], 1)
+        self.assertFalse(response["ok"])
+
+    def test_failing_command_responds_with_error(self):
+        def fail():
+            raise OSError("network is unreachable")
+
+        self.node._ping = fail
+        self.server._handle_line(self.client, b'{"id": 4, "cmd": "ping"}')
+        [response] = self.client.responses()
+        self.assertFalse(response["ok"])
+        self.assertIn("network is unreachable", response["error"])
+
+    def test_wave_without_neighbours_decides(self):
+        self.server._handle_line(self.client, b'{"id": 2, "cmd": "size"}')
+        [response] = self.client.responses()
+        self.assertTrue(response["ok"])
+        self.assertEqual(response["result"]["size"], 1)
+
+    def test_wave_that_never_decides_times_out(self):
+        self.node.neighbours.update(
+            (3, 4), "127.0.0.1", 9, 64, 5.0, time.time()
+        )
+        self.server._handle_line(self.client, b'{"id": 3, "cmd": "size"}')
+        self.assertEqual(self.client.responses(), [])
+
+        controller = self.node.wave_controller
+        controller.expire(time.time() + controller.timeout + 1)
+        [response] = self.client.responses()
+        self.assertEqual(response["id"], 3)
+        self.assertFalse(response["ok"])
+        self.assertEqual(controller.ongoing_waves, {})
+        self.assertEqual(controller._on_decide, {})
+
+
+if __name__ == "__main__":
+    unittest.main()
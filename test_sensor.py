@@ -0,0 +1,80 @@
+"""
+Unit tests for the message format in sensor.
+
+Run with: python -m unittest (or python -m pytest).
+"""
+
+import struct
+import unittest
+
+import sensor
+
+
+class MessageTest(unittest.TestCase):
+    def test_round_trip(self):
+        data = sensor.message_encode(
+            sensor.MSG_ECHO,
+            7,
+            (1, -2),
+            (3, 4),
+            (5, 6),
+            sensor.OP_SIZE,
+            64,
+            1.5,
+        )
+        self.assertEqual(len(data), sensor.message_length)
+        self.assertEqual(
+            sensor.message_decode(data),
+            (
+                sensor.MSG_ECHO,
+                7,
+                (1, -2),
+                (3, 4),
+                (5, 6),
+                sensor.OP_SIZE,
+                64,
+                1.5,
+                b"",
+            ),
+        )
+
+    def test_trailer_is_returned(self):
+        data = sensor.message_encode(
+            sensor.MSG_ECHO_REPLY, 0, (0, 0), (0, 0), trailer=b"extra"
+        )
+        self.assertEqual(sensor.message_decode(data)[-1], b"extra")
+
+    def test_short_buffer_is_rejected(self):
+        data = sensor.message_encode(sensor.MSG_PING, 0, (0, 0), (0, 0))
+        with self.assertRaises(struct.error):
+            sensor.message_decode(data[:-1])
+
+
+class PositionsTest(unittest.TestCase):
+    def test_round_trip(self):
+        positions = [(0, 0), (-5, 7), (2**31 - 1, -(2**31))]
+        trailer = sensor.positions_encode(positions)
+        self.assertEqual(
+            len(trailer), len(positions) * sensor.position_format.size
+        )
+        self.assertEqual(sensor.positions_decode(trailer), positions)
+
+    def test_partial_position_is_ignored(self):
+        trailer = sensor.positions_encode([(1, 2), (3, 4)])
+        self.assertEqual(sensor.positions_decode(trailer[:-3]), [(1, 2)])
+        self.assertEqual(sensor.positions_decode(b""), [])
+
+    def test_max_positions_fit_in_a_datagram(self):
+        positions = [(1, 1)] * sensor.max_positions
+        data = sensor.message_encode(
+            sensor.MSG_ECHO_REPLY,
+            0,
+            (0, 0),
+            (0, 0),
+            trailer=sensor.positions_encode(positions),
+        )
+        self.assertLessEqual(len(data), sensor.max_datagram)
+
+
+if __name__ == "__main__":
+    unittest.main()